@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк AI провайдеров и моделей из telegram_config.json: основная цепочка,
+цепочки чатов (chats), дополнительных ботов (bots) и классов запросов (request_classes).
+Прогоняет фиксированный набор типичных сообщений из чата через каждую модель
+(с ограниченной параллельностью) и измеряет время до первого токена, полное время
+ответа, скорость генерации и долю ошибок (p50/p95/p99).
+Результат - JSON-рейтинг в формате router_state.json: его можно указать как
+router_state_file, чтобы адаптивная маршрутизация стартовала с измеренными значениями.
+
+Использование:
+    python benchmark_models.py [--rounds 2] [--concurrency 2] [--output benchmark_results.json]
+"""
+
+import argparse
+import json
+import sys
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+from telegram_bot import (
+    BotConfig,
+    HttpClient,
+    ProviderRouter,
+    atomic_write,
+    estimate_tokens,
+)
+
+# Устанавливаем UTF-8 для вывода в Windows
+if sys.platform == 'win32':
+    if hasattr(sys.stdout, 'buffer'):
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    if hasattr(sys.stderr, 'buffer'):
+        sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Типичные сообщения из группового чата: короткие реплики, обычные и сложные вопросы
+BENCHMARK_PROMPTS = [
+    "ты тут?",
+    "бот, привет! как дела?",
+    "что думаешь про нашу новую песню?",
+    "когда следующая репетиция?",
+    "посоветуй, какой комбик взять для гитары до 30 тысяч?",
+    "почему у нас на записи барабаны звучат глухо, а вживую нормально?",
+    "объясни, чем отличается компрессор от лимитера и что ставить на вокал",
+    "придумай название для нашего нового альбома, что-нибудь про осень",
+    "скажи Михаилу, что он опять опоздал",
+    "расскажи смешную историю про басиста",
+]
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Перцентиль q (0-100), как Metrics.percentile в telegram_bot.py"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+def run_request(provider_config: Dict, prompt: str, session: requests.Session, timeout: float) -> Dict:
+    """Один потоковый запрос: время до первого токена ответа, полное время и число токенов"""
+    payload = {
+        **provider_config['payload'],
+        "messages": [provider_config['system'], {"role": "user", "content": prompt}],
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+    start_time = time.time()
+    first_token = None
+    parts = []
+    usage = None
+    try:
+        with session.post(provider_config['url'], json=payload, headers=provider_config['request_headers'], timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                return {'ok': False, 'error': f"HTTP {response.status_code}"}
+            response.encoding = 'utf-8'
+            for line in response.iter_lines(decode_unicode=True):
+                if time.time() - start_time > timeout:
+                    return {'ok': False, 'error': 'timeout'}
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                usage = chunk.get('usage') or usage
+                choices = chunk.get('choices') or [{}]
+                piece = (choices[0].get('delta') or {}).get('content') or ''
+                if piece:
+                    if first_token is None:
+                        first_token = time.time() - start_time
+                    parts.append(piece)
+    except requests.exceptions.Timeout:
+        return {'ok': False, 'error': 'timeout'}
+    except Exception as e:
+        return {'ok': False, 'error': str(e)[:100]}
+
+    total = time.time() - start_time
+    text = ''.join(parts)
+    if not text.strip():
+        return {'ok': False, 'error': 'пустой ответ'}
+    # Без usage в потоке число токенов оцениваем по тексту
+    tokens = (usage or {}).get('completion_tokens') or estimate_tokens(text)
+    generation_time = total - first_token
+    return {
+        'ok': True,
+        'ttft': first_token,
+        'total': total,
+        'tokens': tokens,
+        'tokens_per_sec': tokens / generation_time if generation_time > 0 else tokens / total
+    }
+
+def benchmark_provider(provider_config: Dict, prompts: List[str], session: requests.Session, concurrency: int, timeout: float) -> Dict:
+    """Прогоняет набор сообщений через одну модель не более чем в concurrency потоков"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda prompt: run_request(provider_config, prompt, session, timeout), prompts))
+    ok = [r for r in results if r['ok']]
+    errors = [r['error'] for r in results if not r['ok']]
+    totals = [r['total'] for r in ok]
+    ttfts = [r['ttft'] for r in ok]
+    stats = {
+        'count': len(results),
+        'errors': len(errors),
+        'error_rate': len(errors) / len(results),
+        'ttft': {f"p{q}": percentile(ttfts, q) for q in (50, 95, 99)},
+        'total': {f"p{q}": percentile(totals, q) for q in (50, 95, 99)},
+        'tokens_per_sec': sum(r['tokens_per_sec'] for r in ok) / len(ok) if ok else None,
+        'error_samples': sorted(set(errors))[:3]
+    }
+    # Поля маршрутизатора (ProviderRouter.load): задержка неудачной модели - таймаут
+    stats['latency'] = stats['total']['p50'] if ok else timeout
+    stats['success'] = 1 - stats['error_rate']
+    return stats
+
+def all_providers(config: BotConfig) -> List[Dict]:
+    """Все модели, которые может выбрать бот: цепочки ботов, их чатов и классов запросов
+    (каждая модель один раз, по ключу маршрутизатора; первой идёт основная цепочка)"""
+    providers = {}
+    for bot_config in config.all_bots():
+        for chat_config in [bot_config, *bot_config.chats.values()]:
+            for chain in [chat_config.providers, *chat_config.class_providers.values()]:
+                for provider_config in chain:
+                    providers.setdefault(ProviderRouter.key(provider_config), provider_config)
+    return list(providers.values())
+
+def format_seconds(value: Optional[float]) -> str:
+    return f"{value:.2f}" if value is not None else "-"
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк AI провайдеров и моделей из конфигурации бота (основная цепочка, chats, bots и request_classes)")
+    parser.add_argument('--config', default='telegram_config.json', help="файл конфигурации бота")
+    parser.add_argument('--rounds', type=int, default=1, help="сколько раз прогнать набор сообщений через каждую модель")
+    parser.add_argument('--concurrency', type=int, default=2, help="одновременных запросов к одной модели")
+    parser.add_argument('--timeout', type=float, default=60.0, help="максимальное время одного ответа, секунды")
+    parser.add_argument('--models', nargs='*', help="только модели, в ключе которых (\"Провайдер/модель\") есть одна из подстрок")
+    parser.add_argument('--prompts', help="JSON-файл со списком сообщений вместо встроенного набора")
+    parser.add_argument('--output', default='benchmark_results.json', help="файл рейтинга (формат router_state.json)")
+    args = parser.parse_args()
+
+    try:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = BotConfig(json.load(f))
+    except Exception as e:
+        print(f"❌ Ошибка при чтении конфигурации {args.config}: {e}", file=sys.stderr)
+        sys.exit(1)
+    prompts = BENCHMARK_PROMPTS
+    if args.prompts:
+        with open(args.prompts, 'r', encoding='utf-8') as f:
+            prompts = json.load(f)
+    prompts = prompts * max(1, args.rounds)
+
+    providers = all_providers(config)
+    if args.models:
+        providers = [p for p in providers if any(part in ProviderRouter.key(p) for part in args.models)]
+    if not providers:
+        print("❌ Нет настроенных провайдеров для бенчмарка", file=sys.stderr)
+        sys.exit(1)
+
+    session = HttpClient(pool_size=max(1, args.concurrency), connect_timeout=min(10.0, args.timeout), total_timeout=args.timeout)
+    print(f"🏁 Бенчмарк: {len(providers)} моделей, {len(prompts)} сообщений на модель, параллельно {args.concurrency}", file=sys.stderr)
+    results = {}
+    try:
+        # Модели проверяются по очереди, чтобы не мешать друг другу (общие лимиты и канал)
+        for provider_config in providers:
+            key = ProviderRouter.key(provider_config)
+            print(f"🤖 {key}...", file=sys.stderr)
+            results[key] = benchmark_provider(provider_config, prompts, session, max(1, args.concurrency), args.timeout)
+            stats = results[key]
+            print(f"   ответ p50 {format_seconds(stats['total']['p50'])} сек, первый токен p50 {format_seconds(stats['ttft']['p50'])} сек, ошибок {stats['errors']}/{stats['count']}", file=sys.stderr)
+            for error in stats['error_samples']:
+                print(f"   ⚠️ {error}", file=sys.stderr)
+    finally:
+        session.close()
+
+    # Рейтинг тем же критерием, что и у маршрутизатора: задержка / доля успеха
+    router = ProviderRouter()
+    router.stats = {key: {'latency': s['latency'], 'success': s['success'], 'count': s['count']} for key, s in results.items()}
+    ranking = sorted(providers, key=router.score)
+
+    print("\n" + "=" * 100)
+    print(f"{'#':<3}{'Модель':<50}{'TTFT p50/p95/p99':<22}{'Ответ p50/p95/p99':<22}{'ток/с':>7}{'ошибки':>9}")
+    print("=" * 100)
+    for place, provider_config in enumerate(ranking, 1):
+        key = ProviderRouter.key(provider_config)
+        stats = results[key]
+        ttft = '/'.join(format_seconds(stats['ttft'][q]) for q in ('p50', 'p95', 'p99'))
+        total = '/'.join(format_seconds(stats['total'][q]) for q in ('p50', 'p95', 'p99'))
+        speed = f"{stats['tokens_per_sec']:.0f}" if stats['tokens_per_sec'] else "-"
+        print(f"{place:<3}{key[:49]:<50}{ttft:<22}{total:<22}{speed:>7}{stats['error_rate'] * 100:>8.0f}%")
+
+    data = {
+        'updated_at': time.time(),
+        'source': 'benchmark_models.py',
+        'ranking': [ProviderRouter.key(p) for p in ranking],
+        'providers': results
+    }
+    atomic_write(args.output, json.dumps(data, ensure_ascii=False, indent=2))
+    print(f"\n💾 Рейтинг сохранён в {args.output}", file=sys.stderr)
+    print(f"   Чтобы бот стартовал с этими значениями, укажите \"router_state_file\": \"{args.output}\" или скопируйте файл в router_state.json", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
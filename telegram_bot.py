@@ -6,17 +6,38 @@ Telegram бот, который автоматически отвечает го
 Оптимизированная версия с рефакторингом
 """
 
+import asyncio
 import json
 import sys
 import os
 import subprocess
 import time
 import glob
+import hmac
+import importlib.util
 import requests
 import io
+import random
+import re
+import signal
+import socket
+import sqlite3
+import ssl
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from functools import lru_cache
-from typing import Optional, Dict, List, Tuple
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
+from typing import Callable, Optional, Dict, List, Tuple
+from urllib.parse import urlsplit
+
+from urllib3.connection import HTTPConnection
+
+try:
+    import httpx  # необязательно: HTTP/2 к серверам, которые его поддерживают
+except ImportError:
+    httpx = None
 
 # Устанавливаем UTF-8 для вывода в Windows
 if sys.platform == 'win32':
@@ -36,16 +57,153 @@ GROUP_CONTEXT = """В беседе вас четверо: Алексей Тар
 
 Вы часто собираетесь в Мелихово на репетицию, это в Подмосковье. Там дом с тёплым, баня есть, пиво можно выпить."""
 MAX_TOKENS = 300
+LLM_TIMEOUT = 30.0
 TEMPERATURE = 0.7
 AUDIO_MAX_FILES = 50
 LAST_UPDATE_ID_FILE = "last_update_id.txt"
+UPDATE_LEDGER_FILE = "updates.db"
+LEDGER_MAX_ATTEMPTS = 3
+LEDGER_RETENTION_DAYS = 7
+# Неотправленный ответ повторяется через LEDGER_RETRY_DELAY секунд, пока процесс работает;
+# сообщения старше LEDGER_MAX_AGE секунд не досылаются (ответ на них уже неактуален)
+LEDGER_RETRY_DELAY = 60
+LEDGER_MAX_AGE = 3600
+OFFSET_CHECKPOINT_EVERY = 100
+OFFSET_CHECKPOINT_INTERVAL = 5.0
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_CHAT_QUEUE_SIZE = 20
+# Стадии обработки: воркеры, таймаут (сек), размер очереди, поведение при переполнении
+# (block - ждать места, drop_oldest - отбросить самую старую задачу, reject - отказать новой)
+DEFAULT_PIPELINE_STAGES = {
+    'asr': {'workers': 2, 'timeout': 180, 'queue_size': 10, 'policy': 'block'},
+    'llm': {'workers': 4, 'timeout': 180, 'queue_size': 20, 'policy': 'block'},
+    'tts': {'workers': 3, 'timeout': 130, 'queue_size': 20, 'policy': 'block'},
+    'encode': {'workers': 2, 'timeout': 35, 'queue_size': 20, 'policy': 'block'},
+    'send': {'workers': 4, 'timeout': 70, 'queue_size': 20, 'policy': 'block'},
+}
+WEBHOOK_MAX_BODY = 1024 * 1024
+# Классы запросов: короткие реплики - быстрой модели с маленьким лимитом токенов,
+# сложные вопросы - большой модели. slo - целевое время ответа AI (секунды)
+DEFAULT_REQUEST_CLASSES = {
+    'trivial': {'max_chars': 40, 'max_tokens': 100, 'slo': 3.0},
+    'normal': {'slo': 10.0},
+    'complex': {'min_chars': 200, 'slo': 30.0},
+}
+COMPLEX_MARKERS = ('почему', 'зачем', 'объясни', 'расскажи', 'как работает', 'в чём разница', 'в чем разница', 'сравни', 'что лучше', 'посоветуй', 'напиши', 'придумай')
+# Типы обновлений, которые обрабатывает бот (остальные Telegram не присылает - allowed_updates)
+HANDLED_UPDATE_TYPES = ['message']
+DEFAULT_UPDATES_LIMIT = 100
+# Hedging запросов к AI: задержка перед запуском следующего провайдера, пока нет статистики задержек
+HEDGE_DEFAULT_DELAY = 5.0
+HEDGE_MIN_SAMPLES = 5
+# Адаптивный выбор провайдера: сглаживание EWMA, доля исследовательских запросов
+ROUTER_STATE_FILE = "router_state.json"
+ROUTER_EWMA_ALPHA = 0.2
+ROUTER_EXPLORE_RATIO = 0.05
+# Ошибка "стоит" не меньше таймаута запроса: быстрые отказы не должны выглядеть быстрыми ответами
+ROUTER_FAILURE_LATENCY = LLM_TIMEOUT
+# Ниже этой доли успешных ответов провайдер уходит в конец цепочки (после неизмеренных)
+ROUTER_HEALTHY_SUCCESS = 0.5
+# Circuit breaker: сколько ошибок подряд размыкает цепь и через сколько секунд пробный запрос
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 60.0
+# Кэш ответов AI. Версию шаблона промпта нужно менять при изменении compile_system_prompt
+PROMPT_TEMPLATE_VERSION = 2
+RESPONSE_CACHE_SIZE = 500
+RESPONSE_CACHE_TTL = 24 * 3600
+# Потоковая генерация: конец предложения и минимальная длина фрагмента для озвучки
+SENTENCE_END = re.compile(r'[.!?…]+["»)]*\s+')
+STREAM_MIN_SENTENCE_CHARS = 40
+# Провайдеры, принимающие явные маркеры cache_control (OpenAI и Groq кэшируют префикс сами)
+PROMPT_CACHE_PROVIDERS = ('ZenMux', 'OpenRouter')
+# Как провайдер принимает ограничения рассуждений (reasoning_style): openrouter - объект reasoning
+# {effort, max_tokens, enabled}, openai - reasoning_effort, chat_template - enable_thinking (llama.cpp/vLLM)
+REASONING_STYLES = {'ZenMux': 'openrouter', 'OpenRouter': 'openrouter', 'OpenAI': 'openai', 'Groq': 'openai'}
+# Лимиты запросов провайдеров: сколько секунд можно подождать свободного лимита
+# (дольше - запрос уходит следующему провайдеру) и пауза после 429 без Retry-After
+RATE_LIMIT_MAX_WAIT = 3.0
+RATE_LIMIT_DEFAULT_COOLDOWN = 10.0
+# Память диалогов: реплик на чат и бюджет токенов истории в запросе к AI
+MEMORY_MAX_TURNS = 20
+MEMORY_TOKEN_BUDGET = 1000
+RATE_LIMIT_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_TOTAL_TIMEOUT = 120.0
+HTTP_KEEPALIVE = 60.0
+
+def is_placeholder(value) -> bool:
+    """Заглушка из telegram_config.json.example (YOUR_..._HERE) - значение не задано"""
+    return isinstance(value, str) and value.startswith('YOUR_')
+
+def parse_bool(value) -> bool:
+    """Флаг конфигурации: строки "false", "0", "no", "off" (как из переменных окружения) - False"""
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', 'false', '0', 'no', 'off')
+    return bool(value)
 
 class BotConfig:
-    """Класс для хранения конфигурации бота"""
+    """Класс для хранения конфигурации бота.
+    Секции "bots" и "chats" задают несколько ботов и чатов: каждый элемент переопределяет
+    любые поля верхнего уровня (personality, voice_id, модели, ключи провайдеров и т.д.)"""
     def __init__(self, config_dict: dict):
         self.bot_token = config_dict.get('bot_token')
         self.chat_id = config_dict.get('chat_id')
         self.personality = config_dict.get('personality', 'default')
+        # Голос MiniMax для ответов (None - голос из tts_config.json)
+        self.voice_id = None if is_placeholder(config_dict.get('voice_id')) else config_dict.get('voice_id')
+        
+        # Настройки отдельных чатов этого бота (наследуют все поля бота)
+        base = {k: v for k, v in config_dict.items() if k not in ('chats', 'bots')}
+        self.chats: Dict[str, 'BotConfig'] = {}
+        for chat in config_dict.get('chats', []):
+            # Незаполненные чаты и боты из примера конфигурации пропускаются
+            if is_placeholder(chat.get('chat_id')):
+                print("⚠️ Пропускаю чат из секции chats: chat_id не настроен", file=sys.stderr)
+                continue
+            self.chats[str(chat['chat_id'])] = BotConfig({**base, **chat})
+        if self.chat_id and str(self.chat_id) not in self.chats:
+            self.chats[str(self.chat_id)] = self
+        
+        # Дополнительные боты в том же процессе (наследуют поля верхнего уровня)
+        bot_base = {k: v for k, v in base.items() if k != 'chat_id'}
+        self.extra_bots = []
+        for bot in config_dict.get('bots', []):
+            if is_placeholder(bot.get('bot_token')) or is_placeholder(bot.get('chat_id')):
+                print("⚠️ Пропускаю бота из секции bots: bot_token или chat_id не настроен", file=sys.stderr)
+                continue
+            self.extra_bots.append(BotConfig({**bot_base, **bot}))
+        
+        # Конкурентная обработка обновлений
+        self.max_concurrency = max(1, int(config_dict.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)))
+        self.updates_limit = min(100, max(1, int(config_dict.get('updates_limit', DEFAULT_UPDATES_LIMIT))))
+        self.chat_queue_size = max(1, int(config_dict.get('chat_queue_size', DEFAULT_CHAT_QUEUE_SIZE)))
+        # Разные топики форума в одном чате обрабатываются параллельно
+        self.order_by_thread = parse_bool(config_dict.get('order_by_thread', False))
+        self.ledger_file = config_dict.get('ledger_file', UPDATE_LEDGER_FILE)
+        # Склейка серий коротких сообщений одного пользователя (0 - выключено)
+        self.coalesce_window = float(config_dict.get('coalesce_window', 0))
+        self.coalesce_max_wait = float(config_dict.get('coalesce_max_wait', max(self.coalesce_window * 3, 1)))
+        self.coalesce_max_messages = max(1, int(config_dict.get('coalesce_max_messages', 5)))
+        # Настройки стадий: значения из конфига дополняют значения по умолчанию
+        self.pipeline_stages = {
+            name: {**defaults, **config_dict.get('pipeline_stages', {}).get(name, {})}
+            for name, defaults in DEFAULT_PIPELINE_STAGES.items()
+        }
+        self.offset_checkpoint_every = max(1, int(config_dict.get('offset_checkpoint_every', OFFSET_CHECKPOINT_EVERY)))
+        self.offset_checkpoint_interval = float(config_dict.get('offset_checkpoint_interval', OFFSET_CHECKPOINT_INTERVAL))
+        
+        # Режим получения обновлений: polling (getUpdates) или webhook
+        self.mode = config_dict.get('mode', 'polling')
+        self.webhook_url = config_dict.get('webhook_url')
+        self.webhook_host = config_dict.get('webhook_host', '0.0.0.0')
+        self.webhook_port = int(config_dict.get('webhook_port', 8080))
+        self.webhook_path = config_dict.get('webhook_path', '/telegram-webhook')
+        # Секрет обязателен в режиме webhook: он общий для всех экземпляров бота за прокси
+        webhook_secret = config_dict.get('webhook_secret')
+        self.webhook_secret = None if not webhook_secret or is_placeholder(webhook_secret) else webhook_secret
+        # Удалять webhook при остановке (false - если за прокси работает несколько экземпляров)
+        self.webhook_delete_on_exit = parse_bool(config_dict.get('webhook_delete_on_exit', True))
         
         # ZenMux
         self.zenmux_api_key = config_dict.get('zenmux_api_key')
@@ -65,10 +223,79 @@ class BotConfig:
         self.groq_api_key = config_dict.get('groq_api_key')
         self.groq_model = config_dict.get('groq_model', 'llama-3.3-70b-versatile')
         
+        # Реестр провайдеров: любые OpenAI-совместимые endpoints (в том числе локальный llama.cpp/vLLM).
+        # Идут в цепочке раньше провайдеров, заданных ключами zenmux_* / openrouter_* / openai_* / groq_*
+        self.provider_registry = config_dict.get('providers', [])
+        
         # Transcription services
         self.assemblyai_api_key = config_dict.get('assemblyai_api_key')
         self.deepgram_api_key = config_dict.get('deepgram_api_key')
         self.lemonfox_api_key = config_dict.get('lemonfox_api_key')
+        
+        # Hedging: следующий провайдер запускается, не дожидаясь ответа предыдущего,
+        # через hedge_delay секунд или через перцентиль его задержки ("p90")
+        self.llm_hedging = parse_bool(config_dict.get('llm_hedging', False))
+        self.hedge_delay = config_dict.get('hedge_delay', 'p90')
+        self.hedge_max_parallel = max(1, int(config_dict.get('hedge_max_parallel', 2)))
+        # Порядок провайдеров по их задержке и доле успешных ответов (false - фиксированный порядок)
+        self.adaptive_routing = parse_bool(config_dict.get('adaptive_routing', True))
+        self.router_explore_ratio = float(config_dict.get('router_explore_ratio', ROUTER_EXPLORE_RATIO))
+        self.router_state_file = config_dict.get('router_state_file', ROUTER_STATE_FILE)
+        # Circuit breaker для AI провайдеров и сервисов транскрипции
+        self.breaker_failure_threshold = max(1, int(config_dict.get('breaker_failure_threshold', BREAKER_FAILURE_THRESHOLD)))
+        self.breaker_reset_timeout = float(config_dict.get('breaker_reset_timeout', BREAKER_RESET_TIMEOUT))
+        # Кэш ответов AI на повторяющиеся сообщения (response_cache=false в чате - не использовать)
+        self.response_cache = parse_bool(config_dict.get('response_cache', True))
+        self.response_cache_size = max(1, int(config_dict.get('response_cache_size', RESPONSE_CACHE_SIZE)))
+        self.response_cache_ttl = float(config_dict.get('response_cache_ttl', RESPONSE_CACHE_TTL))
+        self.response_cache_file = config_dict.get('response_cache_file')
+        # Потоковая генерация (SSE): каждое готовое предложение сразу озвучивается и отправляется
+        self.stream_responses = parse_bool(config_dict.get('stream_responses', False))
+        # Квоты провайдеров: {"ZenMux/модель" или "Groq": {"rpm": 30, "tpm": 6000}}
+        self.rate_limits = config_dict.get('rate_limits', {})
+        self.rate_limit_max_wait = float(config_dict.get('rate_limit_max_wait', RATE_LIMIT_MAX_WAIT))
+        # Память диалогов: reply - контекст только по цепочке ответов (reply), chat - ещё и последние реплики чата, off - без памяти
+        self.memory_scope = config_dict.get('memory_scope', 'reply')
+        self.memory_max_turns = max(2, int(config_dict.get('memory_max_turns', MEMORY_MAX_TURNS)))
+        self.memory_token_budget = max(0, int(config_dict.get('memory_token_budget', MEMORY_TOKEN_BUDGET)))
+        
+        # HTTP клиент: отдельный пул соединений на каждый хост, HTTP/2 при установленном httpx[http2]
+        self.http2 = parse_bool(config_dict.get('http2', True))
+        self.http_connect_timeout = float(config_dict.get('http_connect_timeout', HTTP_CONNECT_TIMEOUT))
+        self.http_total_timeout = float(config_dict.get('http_total_timeout', HTTP_TOTAL_TIMEOUT))
+        self.http_keepalive = float(config_dict.get('http_keepalive', HTTP_KEEPALIVE))
+        self.http_pool_size = config_dict.get('http_pool_size')
+        # Размер пула для отдельных хостов: {"api.telegram.org": 16}
+        self.http_pools = config_dict.get('http_pools', {})
+        
+        # Ограничения рассуждений reasoning-моделей: {"Провайдер/модель" или "Провайдер": {"effort": "low", "max_tokens": 256, "enabled": false}}
+        self.reasoning = config_dict.get('reasoning', {})
+        
+        # Маркеры cache_control на статической части промпта (кэширование на стороне провайдера)
+        self.prompt_cache = parse_bool(config_dict.get('prompt_cache', True))
+        
+        # Классы запросов (trivial/normal/complex): значения из конфига дополняют значения по умолчанию.
+        # models - предпочтительные модели класса ("Провайдер/модель" или "Провайдер"), max_tokens, timeout, slo
+        self.request_routing = parse_bool(config_dict.get('request_routing', True))
+        self.request_classes = {
+            name: {**defaults, **config_dict.get('request_classes', {}).get(name, {})}
+            for name, defaults in DEFAULT_REQUEST_CLASSES.items()
+        }
+        
+        # Готовые шаблоны запросов к провайдерам (собираются при каждой загрузке конфигурации)
+        self.providers = compile_providers(self)
+        self.class_providers = compile_class_providers(self) if self.request_routing else {}
+    
+    def use_webhook(self) -> bool:
+        return self.mode == 'webhook'
+    
+    def for_chat(self, chat_id) -> Optional['BotConfig']:
+        """Настройки конкретного чата (None - чат не обслуживается этим ботом)"""
+        return self.chats.get(str(chat_id))
+    
+    def all_bots(self) -> List['BotConfig']:
+        """Все боты процесса: основной (если задан bot_token) и из секции bots"""
+        return ([self] if self.bot_token else []) + self.extra_bots
     
     def has_zenmux(self) -> bool:
         return bool(self.zenmux_api_key and self.zenmux_api_key != "YOUR_ZENMUX_API_KEY_HERE")
@@ -83,7 +310,7 @@ class BotConfig:
         return bool(self.groq_api_key and self.groq_api_key != "YOUR_GROQ_API_KEY_HERE")
     
     def has_any_api(self) -> bool:
-        return self.has_zenmux() or self.has_openrouter() or self.has_openai() or self.has_groq()
+        return bool(self.providers)
     
     def has_assemblyai(self) -> bool:
         return bool(self.assemblyai_api_key and self.assemblyai_api_key != "YOUR_ASSEMBLYAI_API_KEY_HERE")
@@ -94,6 +321,790 @@ class BotConfig:
     def has_lemonfox(self) -> bool:
         return bool(self.lemonfox_api_key and self.lemonfox_api_key != "YOUR_LEMONFOX_API_KEY_HERE")
 
+class Metrics:
+    """Простые метрики процесса: счётчики, значения и суммарное время операций"""
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.timings: Dict[str, List[float]] = {}  # имя -> [количество, суммарное время, максимум]
+        self.samples: Dict[str, deque] = {}  # имя -> последние значения (для перцентилей)
+        # Метрики пишут потоки стадий, hedging и опроса, а читает цикл событий
+        self.lock = threading.Lock()
+    
+    def inc(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+    
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            self.samples.setdefault(name, deque(maxlen=200)).append(seconds)
+    
+    def percentile(self, name: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """Перцентиль q (0-100) по последним значениям (None, если значений меньше min_samples)"""
+        with self.lock:
+            values = sorted(self.samples.get(name, ()))
+        if len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(len(values) * q / 100))]
+    
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': {
+                    name: {'count': count, 'avg_ms': round(total / count * 1000, 2) if count else 0, 'max_ms': round(peak * 1000, 2)}
+                    for name, (count, total, peak) in self.timings.items()
+                }
+            }
+    
+    def summary(self) -> str:
+        """Короткая строка для периодического статуса в логе"""
+        snapshot = self.snapshot()
+        parts = [f"{name}={value:g}" for name, value in sorted(snapshot['counters'].items())]
+        parts += [f"{name}={value:g}" for name, value in sorted(snapshot['gauges'].items())]
+        parts += [f"{name}: {t['count']}x avg {t['avg_ms']}ms" for name, t in sorted(snapshot['timings'].items())]
+        return ', '.join(parts)
+
+METRICS = Metrics()
+
+class LRUCache:
+    """Небольшой LRU кэш в памяти (общий для всех ботов и чатов процесса)"""
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.data: OrderedDict = OrderedDict()
+    
+    def get(self, key):
+        if key not in self.data:
+            return None
+        self.data.move_to_end(key)
+        return self.data[key]
+    
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов: пока идёт вызов с ключом key,
+    остальные вызовы с тем же ключом ждут его и получают тот же результат (или ошибку).
+    Вызов доводится до конца, даже если отменён ожидавший его обработчик"""
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: Dict = {}
+    
+    async def do(self, key, func, *args):
+        """Результат await func(*args), общий для всех одновременных вызовов с ключом key"""
+        future = self.calls.get(key)
+        if future is not None:
+            METRICS.inc(f"singleflight.{self.name}.shared")
+            return await asyncio.shield(future)
+        future = asyncio.ensure_future(func(*args))
+        self.calls[key] = future
+        
+        def done(f):
+            if self.calls.get(key) is f:
+                del self.calls[key]
+            # Ошибка уже передана ожидавшим; без этого asyncio пишет "exception was never retrieved"
+            if not f.cancelled():
+                f.exception()
+        
+        future.add_done_callback(done)
+        return await asyncio.shield(future)
+
+def estimate_tokens(text) -> int:
+    """Быстрая оценка числа токенов (для русского текста ~3 символа на токен) + служебные токены сообщения.
+    text - строка или content из частей [{"type": "text", "text": ...}]"""
+    if isinstance(text, list):
+        text = ''.join(part.get('text', '') for part in text)
+    return len(text) // 3 + 4
+
+class ConversationMemory:
+    """Память диалогов: кольцевой буфер последних реплик каждого чата и индекс
+    message_id -> реплика для цепочек reply_to_message. Добавление и вытеснение - O(1)"""
+    def __init__(self, max_turns: int = MEMORY_MAX_TURNS):
+        self.max_turns = max_turns
+        self.turns: Dict[Tuple[str, str], deque] = {}
+        self.index: Dict[Tuple[str, str, int], dict] = {}
+    
+    def add(self, key: Tuple[str, str], role: str, content: str, message_ids: List[int] = (), reply_to: Optional[int] = None):
+        """Добавляет реплику (role: user или assistant); message_ids - сообщения Telegram этой реплики"""
+        turns = self.turns.setdefault(key, deque())
+        if len(turns) >= self.max_turns:
+            for message_id in turns.popleft()['message_ids']:
+                self.index.pop(key + (message_id,), None)
+        turn = {'role': role, 'content': content, 'tokens': estimate_tokens(content), 'message_ids': list(message_ids), 'reply_to': reply_to}
+        turns.append(turn)
+        for message_id in turn['message_ids']:
+            self.index[key + (message_id,)] = turn
+    
+    def history(self, key: Tuple[str, str], reply_to: Optional[int], token_budget: int, whole_chat: bool = False) -> List[Dict]:
+        """Контекст для ответа (messages для API, от старых к новым) не больше token_budget токенов:
+        цепочка reply, если сообщение отвечает на известную реплику, иначе (whole_chat) последние реплики чата"""
+        turn = self.index.get(key + (reply_to,)) if reply_to is not None else None
+        if turn:
+            candidates = []
+            while turn and len(candidates) < self.max_turns:
+                candidates.append(turn)
+                turn = self.index.get(key + (turn['reply_to'],)) if turn['reply_to'] is not None else None
+        elif whole_chat:
+            candidates = reversed(self.turns.get(key, ()))
+        else:
+            return []
+        selected = []
+        used = 0
+        for turn in candidates:
+            used += turn['tokens']
+            if used > token_budget:
+                break
+            selected.append({'role': turn['role'], 'content': turn['content']})
+        selected.reverse()
+        return selected
+
+class ResponseCache(LRUCache):
+    """LRU кэш ответов AI с TTL и (опционально) сохранением на диск между перезапусками"""
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL, file_path: Optional[str] = None):
+        super().__init__(max_size)
+        self.ttl = ttl
+        self.file_path = file_path
+        self.dirty = False
+    
+    @staticmethod
+    def key(text: str, config: 'BotConfig', request_class: Optional[str] = None) -> str:
+        """Нормализованный текст + личность + класс запроса и его модели + версия шаблона промпта
+        (у классов разные модели и лимиты токенов, их ответы не взаимозаменяемы)"""
+        models = ','.join(ROUTER.key(p) for p in config.class_providers.get(request_class) or config.providers)
+        return '\n'.join([' '.join(text.lower().split()), config.personality, request_class or '', models, str(PROMPT_TEMPLATE_VERSION)])
+    
+    def get(self, key):
+        entry = super().get(key)
+        if entry is None:
+            METRICS.inc('cache.llm.miss')
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self.data[key]
+            METRICS.inc('cache.llm.miss')
+            return None
+        METRICS.inc('cache.llm.hit')
+        return value
+    
+    def set(self, key, value):
+        super().set(key, (time.time() + self.ttl, value))
+        self.dirty = True
+    
+    def load(self):
+        if not self.file_path or not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f).get('entries', [])
+            now = time.time()
+            for key, expires_at, value in entries:
+                if expires_at > now:
+                    LRUCache.set(self, key, (expires_at, value))
+            print(f"📋 Загружен кэш ответов из {self.file_path}: {len(self.data)}", file=sys.stderr)
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать {self.file_path}: {e}", file=sys.stderr)
+    
+    def save(self):
+        if not self.file_path or not self.dirty:
+            return
+        entries = [[key, expires_at, value] for key, (expires_at, value) in list(self.data.items())]
+        try:
+            atomic_write(self.file_path, json.dumps({'entries': entries}, ensure_ascii=False))
+            self.dirty = False
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить {self.file_path}: {e}", file=sys.stderr)
+
+class Backoff:
+    """Экспоненциальная задержка с jitter: растёт только при ошибках и сбрасывается при первом успехе,
+    поэтому в здоровом состоянии запросы идут без пауз"""
+    def __init__(self, base: float = 0.5, cap: float = 30.0):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+        self.ready_at = 0.0
+    
+    def failure(self) -> float:
+        """Отмечает ошибку и возвращает задержку до следующей попытки"""
+        self.failures += 1
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** (self.failures - 1)))
+        self.ready_at = time.monotonic() + delay
+        return delay
+    
+    def success(self):
+        self.failures = 0
+        self.ready_at = 0.0
+    
+    async def wait(self):
+        """Ждёт окончания текущей задержки (сразу возвращается, если ошибок не было)"""
+        delay = self.ready_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def atomic_write(file_path: str, data: str):
+    """Атомарная запись файла: временный файл + fsync + rename"""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+# Срок задачи стадии конвейера для текущего потока (time.monotonic): блокирующие вызовы
+# внутри задачи (HTTP, подпроцессы) не ждут дольше, чем стадия ждёт их результат
+STAGE_DEADLINE = threading.local()
+
+def stage_timeout(timeout: float) -> float:
+    """Таймаут блокирующего вызова, урезанный до остатка срока задачи стадии (если он задан)"""
+    deadline = getattr(STAGE_DEADLINE, 'value', None)
+    if deadline is None:
+        return timeout
+    return max(0.1, min(timeout, deadline - time.monotonic()))
+
+def run_with_deadline(deadline: Optional[float], func, *args, **kwargs):
+    """Выполняет func в текущем потоке со сроком задачи стадии deadline"""
+    STAGE_DEADLINE.value = deadline
+    try:
+        return func(*args, **kwargs)
+    finally:
+        STAGE_DEADLINE.value = None
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    """Пул соединений urllib3 одного хоста с TCP keep-alive: простаивающие соединения
+    не обрываются молча NAT/прокси между запросами"""
+    def __init__(self, pool_size: int, keepalive: float):
+        self.keepalive = keepalive
+        super().__init__(pool_connections=1, pool_maxsize=pool_size)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options += [
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(self.keepalive))),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+            ]
+        kwargs['socket_options'] = options
+        super().init_poolmanager(*args, **kwargs)
+    
+    def connections(self) -> int:
+        """Сколько соединений пул открыл за всё время (рост - признак нехватки keep-alive)"""
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys() if key in pools)
+
+class HttpxBody:
+    """Тело ответа httpx в виде response.raw для requests.Response"""
+    def __init__(self, response):
+        self.response = response
+    
+    def stream(self, chunk_size: Optional[int] = None, decode_content: bool = True):
+        try:
+            yield from self.response.iter_bytes(chunk_size)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            # Как urllib3: дочитанное (или брошенное) тело освобождает соединение
+            self.release_conn()
+    
+    def close(self):
+        self.response.close()
+    
+    def release_conn(self):
+        self.response.close()
+
+class HttpxAdapter(requests.adapters.BaseAdapter):
+    """Пул соединений httpx одного хоста: HTTP/2 (мультиплексирование запросов в одном
+    соединении), если сервер его поддерживает, иначе HTTP/1.1 с keep-alive.
+    Ответы и ошибки приводятся к requests, поэтому остальной код не меняется"""
+    def __init__(self, pool_size: int, keepalive: float):
+        super().__init__()
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=keepalive)
+        self.clients: Dict[tuple, 'httpx.Client'] = {}
+        self.lock = threading.Lock()
+    
+    def get_client(self, verify, cert, proxy: Optional[str]) -> 'httpx.Client':
+        """Клиент httpx под настройки TLS и прокси запроса (в httpx они задаются на клиенте,
+        а не на запросе). Обычно настройки одни и клиент тоже один"""
+        key = (verify, cert if not isinstance(cert, list) else tuple(cert), proxy)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = self.clients[key] = httpx.Client(http2=True, limits=self.limits, verify=ssl_context(verify, cert), proxy=proxy)
+        return client
+    
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        try:
+            client = self.get_client(verify, cert, requests.utils.select_proxy(request.url, proxies or {}))
+            http_request = client.build_request(
+                request.method, request.url, headers=dict(request.headers), content=request.body,
+                timeout=httpx.Timeout(read, connect=connect, pool=read)
+            )
+            http_response = client.send(http_request, stream=True)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+        response = requests.Response()
+        response.status_code = http_response.status_code
+        response.reason = http_response.reason_phrase
+        response.headers = requests.structures.CaseInsensitiveDict(http_response.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = HttpxBody(http_response)
+        response.url = str(http_response.url)
+        response.request = request
+        response.connection = self
+        return response
+    
+    def connections(self) -> Optional[int]:
+        return None
+    
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+def ssl_context(verify, cert) -> ssl.SSLContext:
+    """TLS контекст с семантикой requests: verify - True, False или путь к CA bundle,
+    cert - клиентский сертификат (файл или пара сертификат/ключ)"""
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif isinstance(verify, str) and os.path.isdir(verify):
+        context = ssl.create_default_context(capath=verify)
+    else:
+        context = ssl.create_default_context(cafile=verify if isinstance(verify, str) else requests.utils.DEFAULT_CA_BUNDLE_PATH)
+    if cert:
+        context.load_cert_chain(*(cert if isinstance(cert, (tuple, list)) else (cert,)))
+    return context
+
+class HttpClient(requests.Session):
+    """Общий HTTP клиент процесса (Telegram, AI провайдеры, транскрипция): отдельный пул
+    соединений на каждый хост, таймауты (connect, read) и общий срок для потоковых ответов,
+    метрики занятости пулов. Запросы блокирующие и выполняются в потоках стадий (run_blocking)"""
+    def __init__(
+        self,
+        pool_size: int,
+        host_pools: Optional[Dict[str, int]] = None,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        total_timeout: float = HTTP_TOTAL_TIMEOUT,
+        keepalive: float = HTTP_KEEPALIVE,
+        http2: bool = True
+    ):
+        super().__init__()
+        self.pool_size = pool_size
+        self.host_pools = {host.lower(): int(size) for host, size in (host_pools or {}).items()}
+        self.connect_timeout = connect_timeout
+        self.total_timeout = total_timeout
+        self.keepalive = keepalive
+        self.http2 = http2 and httpx is not None
+        if self.http2 and importlib.util.find_spec('h2') is None:
+            # httpx без пакета h2: клиент с http2=True падает на первом же запросе
+            print("⚠️ HTTP/2 недоступен (pip install httpx[http2]), использую HTTP/1.1", file=sys.stderr)
+            self.http2 = False
+        self.host_adapters: Dict[str, requests.adapters.BaseAdapter] = {}
+        self.in_use: Dict[str, int] = {}
+        self.lock = threading.Lock()
+    
+    def get_adapter(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self.lock:
+            adapter = self.host_adapters.get(host)
+            if adapter is None:
+                adapter = self.host_adapters[host] = self.new_adapter(host)
+        return adapter
+    
+    def new_adapter(self, host: str) -> requests.adapters.BaseAdapter:
+        size = self.host_pools.get(host, self.pool_size)
+        if self.http2:
+            return HttpxAdapter(size, self.keepalive)
+        return KeepAliveAdapter(size, self.keepalive)
+    
+    def request(self, method, url, *args, timeout=None, **kwargs):
+        # timeout вызывающего кода - таймаут чтения; подключение ограничено отдельно
+        if timeout is None:
+            timeout = (self.connect_timeout, self.total_timeout)
+        elif not isinstance(timeout, tuple):
+            timeout = (min(self.connect_timeout, timeout), timeout)
+        # Внутри задачи стадии запрос не переживает её срок
+        timeout = tuple(stage_timeout(t) if t is not None else None for t in timeout)
+        total_timeout = stage_timeout(self.total_timeout)
+        host = urlsplit(url).netloc.lower()
+        size = self.host_pools.get(host, self.pool_size)
+        with self.lock:
+            busy = self.in_use.get(host, 0) + 1
+            self.in_use[host] = busy
+        METRICS.gauge(f"http.{host}.in_use", busy)
+        if busy > size:
+            # Пул исчерпан: лишнее соединение откроется и закроется без переиспользования
+            METRICS.inc(f"http.{host}.pool_full")
+        released = []
+        
+        def release():
+            # Один раз на запрос: close() и release_conn() могут вызываться оба
+            with self.lock:
+                if released:
+                    return
+                released.append(True)
+                self.in_use[host] -= 1
+                busy = self.in_use[host]
+            METRICS.gauge(f"http.{host}.in_use", busy)
+        
+        start_time = time.time()
+        try:
+            response = super().request(method, url, *args, timeout=timeout, **kwargs)
+        except Exception as e:
+            if isinstance(e, requests.exceptions.RequestException):
+                METRICS.inc(f"http.{host}.errors")
+            release()
+            raise
+        METRICS.observe(f"http.{host}", time.time() - start_time)
+        if kwargs.get('stream'):
+            # Соединение занято, пока тело не дочитано или ответ не закрыт
+            self.release_on_close(response, release)
+        else:
+            release()
+        # Потоковый ответ читается позже: общий срок проверяет читатель (read_sse_stream)
+        response.deadline = start_time + total_timeout
+        return response
+    
+    @staticmethod
+    def release_on_close(response: requests.Response, release: Callable[[], None]):
+        """Вызывает release, когда соединение потокового ответа возвращается в пул:
+        тело дочитано (raw.release_conn) или ответ закрыт (response.close)"""
+        close = response.close
+        
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+        response.close = close_and_release
+        raw_release = getattr(response.raw, 'release_conn', None)
+        if raw_release is not None:
+            def release_conn():
+                try:
+                    raw_release()
+                finally:
+                    release()
+            response.raw.release_conn = release_conn
+    
+    def update_metrics(self):
+        """Число открытых пулом соединений по хостам (для периодического статуса)"""
+        for host, adapter in list(self.host_adapters.items()):
+            connections = adapter.connections()
+            if connections is not None:
+                METRICS.gauge(f"http.{host}.connections", connections)
+    
+    def close(self):
+        for adapter in self.host_adapters.values():
+            adapter.close()
+        super().close()
+
+class ProviderRouter:
+    """Адаптивный порядок AI провайдеров: по каждой паре (провайдер, модель) хранится
+    EWMA задержки и доли успешных ответов. Цепочка сортируется на каждом запросе,
+    небольшая доля запросов (explore_ratio) уходит не лучшему провайдеру, чтобы
+    восстановившиеся провайдеры снова получали трафик. Состояние сохраняется в JSON"""
+    def __init__(self, alpha: float = ROUTER_EWMA_ALPHA, explore_ratio: float = ROUTER_EXPLORE_RATIO):
+        self.alpha = alpha
+        self.explore_ratio = explore_ratio
+        self.stats: Dict[str, Dict[str, float]] = {}  # "провайдер/модель" -> latency, success, count
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def key(provider_config: Dict) -> str:
+        return f"{provider_config.get('name', 'API')}/{provider_config['model']}"
+    
+    def record(self, provider_config: Dict, seconds: float, ok: bool):
+        """Учитывает результат запроса (ошибка учитывается с задержкой не меньше ROUTER_FAILURE_LATENCY)"""
+        if not ok:
+            seconds = max(seconds, ROUTER_FAILURE_LATENCY)
+        with self.lock:
+            stat = self.stats.get(self.key(provider_config))
+            if stat is None:
+                self.stats[self.key(provider_config)] = {'latency': seconds, 'success': 1.0 if ok else 0.0, 'count': 1}
+                return
+            stat['latency'] += self.alpha * (seconds - stat['latency'])
+            stat['success'] += self.alpha * ((1.0 if ok else 0.0) - stat['success'])
+            stat['count'] += 1
+    
+    @staticmethod
+    def rank(stat: Optional[Dict[str, float]]) -> Tuple[int, float]:
+        """Ключ сортировки (меньше - лучше): сначала здоровые провайдеры по "цене" ответа
+        (задержка, делённая на долю успеха), затем неизмеренные в исходном порядке,
+        затем провайдеры с долей успеха ниже ROUTER_HEALTHY_SUCCESS. Поэтому провайдер,
+        который только отказывает, никогда не обгоняет здорового"""
+        if stat is None:
+            return (1, 0.0)
+        cost = stat['latency'] / max(stat['success'], 0.05)
+        return (0, cost) if stat['success'] >= ROUTER_HEALTHY_SUCCESS else (2, cost)
+    
+    def score(self, provider_config: Dict) -> Tuple[int, float]:
+        return self.rank(self.stats.get(self.key(provider_config)))
+    
+    def order(self, providers: List[Dict]) -> List[Dict]:
+        """Цепочка провайдеров по возрастанию score (при равенстве - исходный приоритет)"""
+        with self.lock:
+            ordered = sorted(providers, key=self.score)
+        if len(ordered) > 1 and random.random() < self.explore_ratio:
+            explored = ordered.pop(random.randrange(1, len(ordered)))
+            ordered.insert(0, explored)
+            METRICS.inc('router.explore')
+        return ordered
+    
+    def load(self, file_path: str):
+        """Загружает сохранённое состояние (или рейтинг из benchmark_models.py) - тот же формат"""
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                providers = json.load(f).get('providers', {})
+            with self.lock:
+                for key, stat in providers.items():
+                    self.stats[key] = {
+                        'latency': float(stat['latency']),
+                        'success': float(stat['success']),
+                        'count': int(stat.get('count', 0))
+                    }
+            print(f"📋 Загружена статистика провайдеров из {file_path}: {len(providers)}", file=sys.stderr)
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать {file_path}: {e}", file=sys.stderr)
+    
+    def save(self, file_path: str):
+        with self.lock:
+            data = {'updated_at': time.time(), 'providers': {key: dict(stat) for key, stat in self.stats.items()}}
+        try:
+            atomic_write(file_path, json.dumps(data, ensure_ascii=False, indent=2))
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить {file_path}: {e}", file=sys.stderr)
+    
+    def summary(self) -> str:
+        """Строка для периодического статуса: провайдеры в текущем порядке"""
+        with self.lock:
+            ranked = sorted(self.stats.items(), key=lambda item: self.rank(item[1]))
+            return ', '.join(f"{key}: {stat['latency']:.1f}с {stat['success'] * 100:.0f}%" for key, stat in ranked)
+
+ROUTER = ProviderRouter()
+
+class CircuitBreaker:
+    """Circuit breaker одного сервиса: после failure_threshold ошибок подряд (ошибка, таймаут, 429)
+    цепь размыкается (open) и запросы к сервису сразу пропускаются. Через reset_timeout
+    пропускается один пробный запрос (half_open): успех замыкает цепь, ошибка снова размыкает"""
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+    
+    def _set_state(self, state: str, reason: str = ''):
+        if state == self.state:
+            return
+        self.state = state
+        METRICS.gauge(f"breaker.{self.name}.open", 0 if state == self.CLOSED else 1)
+        icons = {self.CLOSED: '🟢', self.OPEN: '🔴', self.HALF_OPEN: '🟡'}
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {icons[state]} Circuit breaker {self.name}: {state}{f' ({reason})' if reason else ''}", file=sys.stderr)
+    
+    def allow(self) -> bool:
+        """Можно ли отправить запрос (в half_open - только один пробный)"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN, 'пробный запрос')
+                return True
+            METRICS.inc(f"breaker.{self.name}.skipped")
+            return False
+    
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self._set_state(self.CLOSED)
+    
+    def failure(self, kind: str = 'error'):
+        """Учитывает ошибку: kind - error, timeout или 429"""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    METRICS.inc(f"breaker.{self.name}.tripped")
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN, f"{self.failures} ошибок подряд, последняя: {kind}")
+    
+    def record(self, ok: bool, kind: str = 'error'):
+        if ok:
+            self.success()
+        else:
+            self.failure(kind)
+    
+    def release(self):
+        """Разрешённый allow() запрос так и не был отправлен: пробный запрос достанется следующему"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self._set_state(self.OPEN, 'пробный запрос не отправлен')
+
+class CircuitBreakers:
+    """Реестр circuit breaker'ов по имени сервиса (провайдер/модель, сервис транскрипции)"""
+    def __init__(self):
+        self.failure_threshold = BREAKER_FAILURE_THRESHOLD
+        self.reset_timeout = BREAKER_RESET_TIMEOUT
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+    
+    def get(self, name: str) -> CircuitBreaker:
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+            return self.breakers[name]
+    
+    def summary(self) -> str:
+        """Разомкнутые цепи для периодического статуса"""
+        with self.lock:
+            breakers = sorted(self.breakers.items())
+        return ', '.join(f"{name}: {b.state}" for name, b in breakers if b.state != CircuitBreaker.CLOSED)
+
+BREAKERS = CircuitBreakers()
+
+class TokenBucket:
+    """Token bucket с пополнением per_minute единиц в минуту (запросы или токены)"""
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def wait_time(self, amount: float) -> float:
+        """Через сколько секунд в корзине будет amount единиц"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+    
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+def parse_reset(value: str) -> Optional[float]:
+    """Секунды до сброса лимита из Retry-After / x-ratelimit-reset-*:
+    число секунд, длительность вида 6m0s / 250ms, unix-время или HTTP-дата"""
+    value = value.strip()
+    try:
+        number = float(value)
+        if number > 1e12:  # unix-время в миллисекундах (OpenRouter)
+            return max(0.0, number / 1000 - time.time())
+        if number > 1e9:
+            return max(0.0, number - time.time())
+        return number
+    except ValueError:
+        pass
+    parts = RATE_LIMIT_DURATION.findall(value)
+    if parts:
+        units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+        return sum(float(amount) * units[unit] for amount, unit in parts)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RateLimiter:
+    """Лимиты запросов по провайдеру и модели: token bucket по известным квотам (rpm/tpm)
+    плюс блокировка до сброса лимита по заголовкам Retry-After и x-ratelimit-*"""
+    def __init__(self):
+        self.limits: Dict[str, Dict] = {}
+        self.max_wait = RATE_LIMIT_MAX_WAIT
+        self.buckets: Dict[str, Dict[str, TokenBucket]] = {}
+        self.blocked_until: Dict[str, float] = {}
+        self.lock = threading.Lock()
+    
+    def configure(self, limits: Dict, max_wait: float):
+        with self.lock:
+            self.limits = limits
+            self.max_wait = max_wait
+            self.buckets.clear()
+    
+    def _buckets(self, provider_config: Dict) -> Dict[str, TokenBucket]:
+        """Buckets квоты, под которую попадает модель. Квота провайдера (по имени в rate_limits
+        или rate_limit endpoint из реестра) общая для всех его моделей"""
+        key = ROUTER.key(provider_config)
+        name = provider_config.get('name', '')
+        if key in self.limits:
+            bucket_key, quota = key, self.limits[key]
+        elif name in self.limits:
+            bucket_key, quota = name, self.limits[name]
+        elif provider_config.get('rate_limit'):
+            bucket_key, quota = name, provider_config['rate_limit']
+        else:
+            bucket_key, quota = key, {}
+        if bucket_key not in self.buckets:
+            self.buckets[bucket_key] = {kind: TokenBucket(quota[kind]) for kind in ('rpm', 'tpm') if quota.get(kind)}
+        return self.buckets[bucket_key]
+    
+    def reserve(self, provider_config: Dict, tokens: int) -> Optional[float]:
+        """Резервирует запрос: сколько секунд подождать перед отправкой
+        (None - лимит освободится позже max_wait, запрос лучше отдать другому провайдеру)"""
+        key = ROUTER.key(provider_config)
+        with self.lock:
+            buckets = self._buckets(provider_config)
+            amounts = {'rpm': 1, 'tpm': tokens}
+            wait_time = max([self.blocked_until.get(key, 0) - time.monotonic()] + [b.wait_time(amounts[kind]) for kind, b in buckets.items()])
+            if wait_time > self.max_wait:
+                METRICS.inc(f"ratelimit.{key}.rerouted")
+                return None
+            for kind, bucket in buckets.items():
+                bucket.take(amounts[kind])
+        if wait_time > 0:
+            METRICS.inc(f"ratelimit.{key}.delayed")
+        return max(0.0, wait_time)
+    
+    def update(self, provider_config: Dict, status_code: int, headers):
+        """Учитывает ответ провайдера: 429 и исчерпанные x-ratelimit-remaining-* блокируют
+        модель до сброса лимита"""
+        key = ROUTER.key(provider_config)
+        block_for = None
+        if status_code == 429:
+            retry_after = headers.get('retry-after')
+            block_for = (parse_reset(retry_after) if retry_after else None) or RATE_LIMIT_DEFAULT_COOLDOWN
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            if remaining is not None and reset and remaining.strip() in ('0', '0.0'):
+                block_for = max(block_for or 0.0, parse_reset(reset) or 0.0)
+        # OpenRouter: X-RateLimit-Remaining / X-RateLimit-Reset без суффикса
+        if headers.get('x-ratelimit-remaining', '').strip() == '0' and headers.get('x-ratelimit-reset'):
+            block_for = max(block_for or 0.0, parse_reset(headers['x-ratelimit-reset']) or 0.0)
+        if block_for:
+            with self.lock:
+                self.blocked_until[key] = max(self.blocked_until.get(key, 0), time.monotonic() + block_for)
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🚦 {key}: лимит запросов исчерпан, пауза {block_for:.1f} сек", file=sys.stderr)
+
+RATE_LIMITER = RateLimiter()
+
+def call_with_breaker(name: str, func, *args) -> Optional[str]:
+    """Вызывает сервис транскрипции через его circuit breaker (None - ошибка или цепь разомкнута)"""
+    breaker = BREAKERS.get(name)
+    if not breaker.allow():
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏭️ {name}: цепь разомкнута после ошибок, пропускаю", file=sys.stderr)
+        return None
+    result = func(*args)
+    breaker.record(bool(result))
+    return result
+
 @lru_cache(maxsize=10)
 def get_personality_prompt(personality="default"):
     """Возвращает описание личности для промпта (кэшируется)"""
@@ -118,82 +1129,295 @@ def get_personality_prompt(personality="default"):
     
     return personalities.get(personality, personality)
 
-def build_prompt(text: str, personality: str) -> str:
-    """Строит промпт для AI (кэшируется через get_personality_prompt)"""
+@lru_cache(maxsize=10)
+def compile_system_prompt(personality: str) -> str:
+    """Статическая часть промпта (личность + контекст группы) для system-сообщения.
+    Собирается один раз на личность, в запросе меняется только сообщение пользователя"""
     personality_desc = get_personality_prompt(personality)
     return f"""{personality_desc}
 
-Контекст: тебе написали в групповом чате.
+Контекст: тебе пишут в групповом чате.
 {GROUP_CONTEXT}
-Сообщение: {text}
 
-Ответь на это сообщение естественно, как в обычном разговоре."""
+Отвечай на сообщения естественно, как в обычном разговоре."""
+
+def reasoning_params(provider_config: Dict, reasoning: Optional[Dict], max_tokens: int) -> Dict:
+    """Поля запроса, ограничивающие рассуждения модели: effort (none/minimal/low/...),
+    max_tokens (бюджет токенов рассуждения) или enabled=false, в формате провайдера"""
+    if not reasoning:
+        return {}
+    style = provider_config.get('reasoning_style') or REASONING_STYLES.get(provider_config.get('name'), 'openai')
+    enabled = reasoning.get('enabled', True) and reasoning.get('effort') != 'none'
+    if style == 'chat_template':
+        return {"chat_template_kwargs": {"enable_thinking": enabled}}
+    if style == 'openrouter':
+        if not enabled:
+            return {"reasoning": {"enabled": False}}
+        # effort и max_tokens взаимоисключающие: явный бюджет токенов точнее уровня
+        params = {k: reasoning[k] for k in ('max_tokens' if reasoning.get('max_tokens') else 'effort', 'exclude') if k in reasoning}
+        # Бюджет рассуждения входит в max_tokens: ответ сохраняет свои max_tokens сверх него
+        return {"reasoning": params, "max_tokens": max_tokens + int(params.get('max_tokens', 0))}
+    # reasoning_effort (OpenAI, Groq): отдельного бюджета токенов нет, только уровень
+    effort = reasoning.get('effort') or (None if enabled else 'none')
+    return {"reasoning_effort": effort} if effort else {}
+
+def build_payload(provider_config: Dict, max_tokens: int = MAX_TOKENS, reasoning: Optional[Dict] = None) -> Dict:
+    """Каркас payload: модель, температура, лимит токенов и ограничения рассуждений
+    (reasoning класса запроса важнее reasoning модели)"""
+    return {
+        "model": provider_config['model'],
+        "temperature": TEMPERATURE,
+        "max_tokens": max_tokens,
+        **reasoning_params(provider_config, reasoning or provider_config.get('reasoning'), max_tokens)
+    }
+
+def compile_provider(provider_config: Dict, personality: str, prompt_cache: bool = True) -> Dict:
+    """Шаблон запроса к провайдеру: готовые заголовки, каркас payload и system-сообщение.
+    system-сообщение - стабильный префикс каждого запроса; для провайдеров с явным
+    кэшированием промпта он помечается cache_control"""
+    system_prompt = compile_system_prompt(personality)
+    if prompt_cache and provider_config.get('prompt_cache', provider_config.get('name') in PROMPT_CACHE_PROVIDERS):
+        system = {"role": "system", "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]}
+    else:
+        system = {"role": "system", "content": system_prompt}
+    # auth: bearer (Authorization: Bearer <ключ>), none (локальный сервер без ключа)
+    # или имя заголовка, в который ключ передаётся как есть (например api-key)
+    auth = provider_config.get('auth', 'bearer')
+    if auth == 'bearer':
+        auth_headers = {"Authorization": f"Bearer {provider_config['api_key']}"}
+    elif auth == 'none':
+        auth_headers = {}
+    else:
+        auth_headers = {auth: provider_config['api_key']}
+    return {
+        **provider_config,
+        'request_headers': {
+            **auth_headers,
+            "Content-Type": "application/json",
+            **provider_config.get('headers', {})
+        },
+        'payload': build_payload(provider_config),
+        'system': system
+    }
 
 def generate_response_with_provider(
     text: str,
     provider_config: Dict,
     session: requests.Session,
-    personality: str
+    personality: str,
+    cancelled: Optional[threading.Event] = None,
+    on_sentence: Optional[Callable[[str], None]] = None,
+    history: Optional[List[Dict]] = None
 ) -> Optional[str]:
     """
     Универсальная функция для генерации ответа через любой AI провайдер
     provider_config должен содержать: url, api_key, model, headers (опционально)
+    cancelled - событие отмены (hedging): если ответ уже получен от другого провайдера, запрос не отправляется,
+    а уже отправленный прерывается (ответ закрывается, не дочитываясь)
+    on_sentence - потоковый режим (stream: true): готовые предложения передаются в on_sentence по мере генерации
+    history - предыдущие реплики диалога (ConversationMemory.history)
     """
-    if not provider_config.get('api_key') or provider_config['api_key'].startswith('YOUR_'):
+    if not has_credentials(provider_config):
         return None
+    if cancelled is not None and cancelled.is_set():
+        return None
+    # Провайдеры из конфигурации уже скомпилированы (BotConfig.providers), остальные собираем на месте
+    if 'payload' not in provider_config:
+        provider_config = compile_provider(provider_config, personality)
+    
+    messages = [provider_config['system']] + (history or []) + [{"role": "user", "content": text}]
+    # Провайдер с разомкнутой цепью пропускается сразу, без ожидания таймаута
+    breaker = BREAKERS.get(f"llm:{ROUTER.key(provider_config)}")
+    if not breaker.allow():
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏭️ {provider_config.get('name', 'API')} ({provider_config['model']}): цепь разомкнута после ошибок, пропускаю", file=sys.stderr)
+        return None
+    # Лимиты резервируются только для запроса, который breaker пропустил:
+    # короткое ожидание свободного лимита или сразу следующий провайдер (пробный запрос half_open возвращается)
+    wait_time = RATE_LIMITER.reserve(provider_config, sum(estimate_tokens(m['content']) for m in messages) + provider_config['payload'].get('max_tokens', MAX_TOKENS))
+    if wait_time is None:
+        breaker.release()
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🚦 {provider_config.get('name', 'API')} ({provider_config['model']}): лимит запросов исчерпан, пропускаю", file=sys.stderr)
+        return None
+    if wait_time > 0:
+        time.sleep(wait_time)
     
     url = provider_config['url']
-    api_key = provider_config['api_key']
     model = provider_config['model']
-    custom_headers = provider_config.get('headers', {})
-    
-    prompt = build_prompt(text, personality)
-    
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": TEMPERATURE,
-        "max_tokens": MAX_TOKENS
-    }
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        **custom_headers
-    }
-    
+    headers = provider_config['request_headers']
+    payload = {**provider_config['payload'], "messages": messages}
+    if on_sentence:
+        payload["stream"] = True
+        # usage (в том числе закэшированные токены) приходит последним событием потока
+        payload["stream_options"] = {"include_usage": True}
+    
+    start_time = time.time()
+    content = None
+    failure_kind = 'error'
+    response = None
     try:
-        response = session.post(url, json=payload, headers=headers, timeout=30)
+        # С отменой тело читается по частям, чтобы проигравший запрос можно было бросить
+        response = session.post(url, json=payload, headers=headers, timeout=provider_config.get('timeout', LLM_TIMEOUT), stream=bool(on_sentence) or cancelled is not None)
+        RATE_LIMITER.update(provider_config, response.status_code, response.headers)
         
-        if response.status_code == 200:
-            result = response.json()
+        if response.status_code == 200 and on_sentence:
+            content, complete = read_sse_stream(response, on_sentence, start_time, provider_config, cancelled)
+            if content and not complete:
+                # Оборванный ответ - ошибка провайдера, а не успешный ответ
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ {provider_config.get('name', 'API')} ({model}): поток ответа оборвался", file=sys.stderr)
+                content = None
+            if content:
+                METRICS.observe(provider_key(provider_config), time.time() - start_time)
+        elif response.status_code == 200:
+            result = read_json(response, cancelled) or {}
+            record_usage(provider_config, result.get('usage'))
             if 'choices' in result and len(result['choices']) > 0:
                 message = result['choices'][0].get('message', {})
                 content = message.get('content', '')
                 # Для ZenMux: проверяем reasoning если content пустой
                 if not content and 'reasoning' in message:
+                    # Модель израсходовала лимит на рассуждение: стоит ограничить reasoning для неё
+                    METRICS.inc(f"llm.{ROUTER.key(provider_config)}.reasoning_fallback")
                     content = message.get('reasoning', '')
                 if content:
-                    return content.strip()
+                    # Задержка успешных ответов - основа для hedge_delay вида "p90"
+                    METRICS.observe(provider_key(provider_config), time.time() - start_time)
         elif response.status_code == 429:
+            failure_kind = '429'
             print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ {provider_config.get('name', 'API')} ({model}): Превышен лимит запросов (429)", file=sys.stderr)
         else:
             error_text = response.text[:200] if hasattr(response, 'text') else str(response.status_code)
             print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка {provider_config.get('name', 'API')} ({model}) {response.status_code}: {error_text}", file=sys.stderr)
             
     except requests.exceptions.Timeout:
+        failure_kind = 'timeout'
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Таймаут при обращении к {provider_config.get('name', 'API')} ({model})", file=sys.stderr)
     except Exception as e:
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка при вызове {provider_config.get('name', 'API')} ({model}): {e}", file=sys.stderr)
+    finally:
+        # Поток после [DONE] или ошибки дочитан не до конца: соединение освобождается явно
+        if response is not None:
+            response.close()
     
-    return None
+    if not content and cancelled is not None and cancelled.is_set():
+        # Ответ уже получен от другого провайдера: прерванный запрос - не ошибка этого провайдера
+        breaker.release()
+        return None
+    ROUTER.record(provider_config, time.time() - start_time, bool(content))
+    breaker.record(bool(content), failure_kind)
+    return content.strip() if content else None
 
-def generate_response(text: str, config: BotConfig, session: requests.Session) -> Optional[str]:
-    """
-    Генерирует ответ используя провайдеры в порядке приоритета:
-    ZenMux (основная + запасные модели) -> OpenRouter -> OpenAI -> Groq
-    """
-    # Пробуем ZenMux
+def split_sentences(buffer: str, min_chars: int = STREAM_MIN_SENTENCE_CHARS) -> Tuple[List[str], str]:
+    """Отделяет от буфера законченные предложения (короткие склеиваются до min_chars).
+    Возвращает предложения и незаконченный остаток"""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(buffer):
+        if match.end() - start >= min_chars:
+            sentences.append(buffer[start:match.end()].strip())
+            start = match.end()
+    return sentences, buffer[start:]
+
+def record_usage(provider_config: Dict, usage: Optional[Dict]):
+    """Учитывает токены ответа: prompt, completion и взятые из кэша промпта провайдера"""
+    if not usage:
+        return
+    details = usage.get('prompt_tokens_details') or {}
+    cached = details.get('cached_tokens') or usage.get('cache_read_input_tokens') or 0
+    # Токены рассуждения входят в completion_tokens: ответ = completion - reasoning
+    reasoning = (usage.get('completion_tokens_details') or {}).get('reasoning_tokens') or 0
+    METRICS.inc('llm.tokens.prompt', usage.get('prompt_tokens') or 0)
+    METRICS.inc('llm.tokens.completion', usage.get('completion_tokens') or 0)
+    METRICS.inc('llm.tokens.reasoning', reasoning)
+    METRICS.inc('llm.tokens.output', max(0, (usage.get('completion_tokens') or 0) - reasoning))
+    METRICS.inc('llm.tokens.cached', cached)
+    if reasoning:
+        METRICS.inc(f"llm.{ROUTER.key(provider_config)}.reasoning_tokens", reasoning)
+    if cached:
+        METRICS.inc(f"llm.{ROUTER.key(provider_config)}.cached_tokens", cached)
+
+def read_json(response: requests.Response, cancelled: Optional[threading.Event] = None) -> Optional[Dict]:
+    """JSON тело ответа; с событием отмены читается по частям и бросается (None), как только оно установлено"""
+    if cancelled is None:
+        return response.json()
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=8192):
+        if cancelled.is_set():
+            return None
+        body += chunk
+    return json.loads(body)
+
+def read_sse_stream(
+    response: requests.Response,
+    on_sentence: Callable[[str], None],
+    start_time: float,
+    provider_config: Optional[Dict] = None,
+    cancelled: Optional[threading.Event] = None
+) -> Tuple[str, bool]:
+    """Читает поток server-sent events chat/completions: законченные предложения сразу
+    передаются в on_sentence. Возвращает текст ответа и признак, что поток дошёл до конца
+    ([DONE] или finish_reason), а не оборвался на середине (или не был отменён)"""
+    # text/event-stream часто приходит без charset, а requests тогда считает его latin-1
+    response.encoding = 'utf-8'
+    parts = []
+    buffer = ''
+    complete = False
+    deadline = getattr(response, 'deadline', None)
+    for line in response.iter_lines(decode_unicode=True):
+        # Таймаут чтения ограничивает паузу между событиями, а не длину всего ответа
+        if deadline and time.time() > deadline:
+            raise requests.exceptions.Timeout('превышено общее время ответа')
+        if cancelled is not None and cancelled.is_set():
+            break
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            complete = True
+            break
+        chunk = json.loads(data)
+        if provider_config and chunk.get('usage'):
+            record_usage(provider_config, chunk['usage'])
+        choices = chunk.get('choices') or [{}]
+        if choices[0].get('finish_reason'):
+            complete = True
+        piece = (choices[0].get('delta') or {}).get('content') or ''
+        if not piece:
+            continue
+        if not parts:
+            METRICS.observe('llm.first_token', time.time() - start_time)
+        parts.append(piece)
+        sentences, buffer = split_sentences(buffer + piece)
+        for sentence in sentences:
+            on_sentence(sentence)
+    # Хвост оборванного потока - обрывок предложения, его не озвучиваем
+    if complete and buffer.strip():
+        on_sentence(buffer.strip())
+    return ''.join(parts), complete
+
+def provider_key(provider_config: Dict) -> str:
+    """Имя метрики задержки провайдера и модели"""
+    return f"llm.{provider_config.get('name', 'API')}.{provider_config['model']}"
+
+def provider_chain(config: BotConfig, request_class: Optional[str] = None) -> List[Dict]:
+    """Скомпилированные провайдеры конфигурации (или класса запроса) в порядке приоритета.
+    С adaptive_routing ROUTER сортирует отдельно модели класса и остальную цепочку,
+    чтобы быстрые запасные модели не обгоняли выбранные для класса"""
+    providers = config.class_providers.get(request_class) or config.providers
+    if config.adaptive_routing:
+        providers = ROUTER.order([p for p in providers if p.get('preferred')]) + ROUTER.order([p for p in providers if not p.get('preferred')])
+    return providers
+
+def has_credentials(provider_config: Dict) -> bool:
+    """Есть ли у провайдера ключ (локальному серверу с auth=none ключ не нужен)"""
+    if provider_config.get('auth', 'bearer') == 'none':
+        return True
+    api_key = provider_config.get('api_key')
+    return bool(api_key and not api_key.startswith('YOUR_'))
+
+def legacy_providers(config: BotConfig) -> List[Dict]:
+    """Провайдеры из ключей zenmux_* / openrouter_* / openai_* / groq_* в формате реестра
+    (ZenMux: основная + запасные модели -> OpenRouter -> OpenAI -> Groq)"""
+    providers = []
     if config.has_zenmux():
         models_to_try = [config.zenmux_model]
         if config.fallback_models:
@@ -202,99 +1426,285 @@ def generate_response(text: str, config: BotConfig, session: requests.Session) -
             fallback = "google/gemini-3-pro-preview"
             if fallback not in models_to_try:
                 models_to_try.append(fallback)
-        
-        for i, model in enumerate(models_to_try):
-            if i == 0:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🤖 Пробую основную модель ZenMux: {model}", file=sys.stderr)
-            else:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 Модель ZenMux {i} не ответила, пробую следующую: {model}", file=sys.stderr)
-            
-            provider_config = {
-                'name': 'ZenMux',
-                'url': f"{config.zenmux_base_url}/chat/completions",
-                'api_key': config.zenmux_api_key,
-                'model': model
-            }
-            
-            response = generate_response_with_provider(text, provider_config, session, config.personality)
-            if response:
-                if i > 0:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Модель ZenMux {model} сработала!", file=sys.stderr)
-                return response
-        
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Все модели ZenMux не ответили", file=sys.stderr)
-    else:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ ZenMux не настроен (нет API ключа)", file=sys.stderr)
+        providers.append({
+            'name': 'ZenMux',
+            'base_url': config.zenmux_base_url,
+            'api_key': config.zenmux_api_key,
+            'models': models_to_try
+        })
     
-    # Пробуем OpenRouter
     if config.has_openrouter():
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 ZenMux не ответил, пробую OpenRouter: {config.openrouter_model}", file=sys.stderr)
-        provider_config = {
+        providers.append({
             'name': 'OpenRouter',
-            'url': 'https://openrouter.ai/api/v1/chat/completions',
+            'base_url': 'https://openrouter.ai/api/v1',
             'api_key': config.openrouter_api_key,
-            'model': config.openrouter_model,
+            'models': [config.openrouter_model],
             'headers': {
                 'HTTP-Referer': 'https://github.com/telegram-bot',
                 'X-Title': 'Telegram Bot'
             }
-        }
-        response = generate_response_with_provider(text, provider_config, session, config.personality)
-        if response:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ OpenRouter сработал!", file=sys.stderr)
-            return response
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ OpenRouter тоже не ответил", file=sys.stderr)
-    else:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ OpenRouter не настроен (нет API ключа)", file=sys.stderr)
+        })
     
-    # Пробуем OpenAI
     if config.has_openai():
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 OpenRouter не ответил, пробую OpenAI: {config.openai_model}", file=sys.stderr)
-        provider_config = {
+        providers.append({
             'name': 'OpenAI',
-            'url': 'https://api.openai.com/v1/chat/completions',
+            'base_url': 'https://api.openai.com/v1',
             'api_key': config.openai_api_key,
-            'model': config.openai_model
-        }
-        response = generate_response_with_provider(text, provider_config, session, config.personality)
-        if response:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ OpenAI сработал!", file=sys.stderr)
-            return response
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ OpenAI тоже не ответил", file=sys.stderr)
+            'models': [config.openai_model]
+        })
     
-    # Пробуем Groq
     if config.has_groq():
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 Пробую Groq: {config.groq_model}", file=sys.stderr)
-        provider_config = {
+        providers.append({
             'name': 'Groq',
-            'url': 'https://api.groq.com/openai/v1/chat/completions',
+            'base_url': 'https://api.groq.com/openai/v1',
             'api_key': config.groq_api_key,
-            'model': config.groq_model
-        }
-        response = generate_response_with_provider(text, provider_config, session, config.personality)
-        if response:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Groq сработал!", file=sys.stderr)
-            return response
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Groq тоже не ответил", file=sys.stderr)
-    else:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Groq не настроен (нет API ключа)", file=sys.stderr)
+            'models': [config.groq_model]
+        })
+    return providers
+
+def model_reasoning(config: BotConfig, endpoint: Dict, model: str) -> Optional[Dict]:
+    """reasoning модели: по "Провайдер/модель", затем по имени провайдера, затем из endpoint реестра"""
+    name = endpoint.get('name', 'API')
+    return config.reasoning.get(f"{name}/{model}") or config.reasoning.get(name) or endpoint.get('reasoning')
+
+def compile_providers(config: BotConfig) -> List[Dict]:
+    """
+    Цепочка провайдеров в порядке приоритета: сначала реестр из секции providers,
+    затем провайдеры из ключей (legacy_providers). Каждая модель каждого endpoint
+    сразу компилируется в шаблон запроса (compile_provider)
+    """
+    providers = []
+    for endpoint in config.provider_registry + legacy_providers(config):
+        if not has_credentials(endpoint):
+            continue
+        url = endpoint.get('url') or f"{endpoint['base_url'].rstrip('/')}/chat/completions"
+        settings = {k: v for k, v in endpoint.items() if k not in ('base_url', 'models', 'model')}
+        for model in endpoint.get('models') or [endpoint['model']]:
+            name = endpoint.get('name', 'API')
+            providers.append({
+                **settings,
+                'name': name,
+                'url': url,
+                'model': model,
+                'timeout': float(endpoint.get('timeout', LLM_TIMEOUT)),
+                'reasoning': model_reasoning(config, endpoint, model)
+            })
+    return [compile_provider(provider_config, config.personality, config.prompt_cache) for provider_config in providers]
+
+def resolve_providers(config: BotConfig, providers: List[Dict], ref: str) -> List[Dict]:
+    """Провайдеры цепочки по ссылке "Провайдер/модель" или "Провайдер". Модель, которой нет
+    в цепочке, берётся у провайдера с тем же именем (тот же endpoint и ключ, другая модель,
+    свой reasoning)"""
+    exact = [p for p in providers if ROUTER.key(p) == ref or p['name'] == ref]
+    if exact:
+        return exact
+    name, _, model = ref.partition('/')
+    for provider_config in providers:
+        if provider_config['name'] == name and model:
+            endpoint = next((e for e in config.provider_registry + legacy_providers(config) if e.get('name', 'API') == name), {'name': name})
+            clone = {**provider_config, 'model': model, 'reasoning': model_reasoning(config, endpoint, model)}
+            return [{**clone, 'payload': build_payload(clone)}]
+    return []
+
+def compile_class_providers(config: BotConfig) -> Dict[str, List[Dict]]:
+    """Цепочка провайдеров для каждого класса запросов: сначала модели класса,
+    затем остальная цепочка как запасная; лимит токенов класса - только у моделей класса,
+    таймаут класса - у всех"""
+    chains = {}
+    for name, settings in config.request_classes.items():
+        preferred = []
+        for ref in settings.get('models', []):
+            preferred += [p for p in resolve_providers(config, config.providers, ref) if ROUTER.key(p) not in {ROUTER.key(q) for q in preferred}]
+        preferred_keys = {ROUTER.key(p) for p in preferred}
+        chain = []
+        for provider_config in preferred + [p for p in config.providers if ROUTER.key(p) not in preferred_keys]:
+            provider_config = {**provider_config, 'request_class': name, 'preferred': ROUTER.key(provider_config) in preferred_keys}
+            # Маленький лимит класса обрезал бы ответ reasoning-модели из запасной цепочки
+            # до одних рассуждений, поэтому он только для моделей класса. reasoning класса -
+            # для моделей класса и моделей с настроенным reasoning: обычные модели отклоняют
+            # незнакомые поля reasoning_effort/reasoning
+            max_tokens = settings.get('max_tokens') if provider_config['preferred'] else None
+            reasoning = settings.get('reasoning') if provider_config['preferred'] or provider_config.get('reasoning') else None
+            if max_tokens or reasoning:
+                provider_config['payload'] = build_payload(provider_config, int(max_tokens or MAX_TOKENS), reasoning)
+            if settings.get('timeout'):
+                provider_config['timeout'] = float(settings['timeout'])
+            chain.append(provider_config)
+        chains[name] = chain
+    return chains
+
+def classify_request(text: str, trigger: Optional[str], config: BotConfig) -> str:
+    """Класс запроса по длине, причине ответа (respond_trigger) и признакам вопроса:
+    trivial - короткая реплика ("ты тут?"), complex - длинный или "объясни/почему"-вопрос"""
+    classes = config.request_classes
+    text_lower = text.lower()
+    questions = text.count('?')
+    if len(text) >= classes['complex'].get('min_chars', 200) or questions > 1 or any(marker in text_lower for marker in COMPLEX_MARKERS):
+        return 'complex'
+    # Ключевые слова ("помоги", "скажи") - это просьба, а не короткая реплика
+    if len(text) <= classes['trivial'].get('max_chars', 40) and trigger != 'keyword':
+        return 'trivial'
+    return 'normal'
+
+def record_class_latency(config: BotConfig, request_class: Optional[str], seconds: float):
+    """Время ответа AI по классу запроса и промахи мимо SLO класса"""
+    if not request_class:
+        return
+    METRICS.observe(f"llm.class.{request_class}", seconds)
+    slo = config.request_classes.get(request_class, {}).get('slo')
+    if slo and seconds > slo:
+        METRICS.inc(f"llm.class.{request_class}.slo_miss")
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏱️ Ответ ({request_class}) за {seconds:.1f} сек - дольше SLO {slo:g} сек", file=sys.stderr)
+
+# Потоки для параллельных (hedged) запросов к провайдерам (размер задаёт configure_hedging)
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='llm-hedge')
+
+def configure_hedging(workers: int):
+    """Пул hedged запросов на workers потоков: каждый воркер стадии llm держит до
+    hedge_max_parallel запросов, и основной запрос не должен ждать свободного потока"""
+    global HEDGE_EXECUTOR
+    previous = HEDGE_EXECUTOR
+    HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='llm-hedge')
+    previous.shutdown(wait=False)
+
+def hedge_delay_for(provider_config: Dict, hedge_delay) -> float:
+    """Сколько ждать ответа провайдера перед запуском следующего: число секунд
+    или перцентиль его задержки ("p90"; пока статистики мало - HEDGE_DEFAULT_DELAY)"""
+    if isinstance(hedge_delay, str) and hedge_delay.startswith('p'):
+        value = METRICS.percentile(provider_key(provider_config), float(hedge_delay[1:]), HEDGE_MIN_SAMPLES)
+        return value if value is not None else HEDGE_DEFAULT_DELAY
+    return float(hedge_delay)
+
+def generate_response_hedged(
+    text: str,
+    providers: List[Dict],
+    session: requests.Session,
+    personality: str,
+    hedge_delay,
+    max_parallel: int = 2,
+    history: Optional[List[Dict]] = None
+) -> Optional[str]:
+    """
+    Hedged запрос: провайдеры запускаются по порядку приоритета, но следующий не ждёт
+    окончания предыдущего - он стартует через hedge_delay или сразу после ошибки.
+    Возвращается первый успешный ответ, остальные запросы отменяются
+    (ещё не отправленные не отправляются, ответы уже отправленных закрываются)
+    """
+    cancelled = threading.Event()
+    queue = list(providers)
+    running = {}
+    deadline = getattr(STAGE_DEADLINE, 'value', None)
+    
+    def launch():
+        provider_config = queue.pop(0)
+        if running:
+            METRICS.inc('llm.hedge.launched')
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔀 Параллельно запускаю {provider_config['name']}: {provider_config['model']}", file=sys.stderr)
+        else:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🤖 Пробую {provider_config['name']}: {provider_config['model']}", file=sys.stderr)
+        # Параллельные запросы наследуют срок задачи стадии llm
+        future = HEDGE_EXECUTOR.submit(partial(run_with_deadline, deadline, generate_response_with_provider, text, provider_config, session, personality, cancelled, history=history))
+        running[future] = provider_config
+        return provider_config
     
-    # Финальное сообщение, если все провайдеры не сработали
-    available_providers = []
-    if config.has_zenmux():
-        available_providers.append("ZenMux")
-    if config.has_openrouter():
-        available_providers.append("OpenRouter")
-    if config.has_openai():
-        available_providers.append("OpenAI")
-    if config.has_groq():
-        available_providers.append("Groq")
+    last_started = launch()
+    try:
+        while running:
+            timeout = hedge_delay_for(last_started, hedge_delay) if queue and len(running) < max_parallel else None
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                provider_config = running.pop(future)
+                response = future.result()
+                if response:
+                    if provider_config is not providers[0]:
+                        METRICS.inc('llm.hedge.won')
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ {provider_config['name']} ({provider_config['model']}) ответил первым", file=sys.stderr)
+                    return response
+            # Задержка истекла или провайдер ответил ошибкой - подключаем следующего
+            if queue and len(running) < max_parallel:
+                last_started = launch()
+    finally:
+        cancelled.set()
+        for future in running:
+            future.cancel()
+    return None
+
+def generate_response_stream(
+    text: str,
+    config: BotConfig,
+    session: requests.Session,
+    on_sentence: Callable[[str], None],
+    history: Optional[List[Dict]] = None,
+    request_class: Optional[str] = None
+) -> Tuple[Optional[str], bool]:
+    """
+    Потоковая генерация: провайдеры в том же порядке, что и в generate_response,
+    предложения ответа передаются в on_sentence по мере генерации. Следующий провайдер
+    пробуется, только если предыдущий не успел отдать ни одного предложения.
+    Возвращает текст и признак полного ответа (False - поток оборвался, текст - уже
+    озвученная часть: её нельзя кэшировать)
+    """
+    providers = provider_chain(config, request_class)
+    start_time = time.time()
+    emitted = []
     
-    if available_providers:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Все настроенные провайдеры не ответили: {', '.join(available_providers)}", file=sys.stderr)
-    else:
+    def emit(sentence: str):
+        emitted.append(sentence)
+        on_sentence(sentence)
+    
+    for provider_config in providers:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🤖 Пробую {provider_config['name']} (потоково): {provider_config['model']}", file=sys.stderr)
+        response = generate_response_with_provider(text, provider_config, session, config.personality, on_sentence=emit, history=history)
+        if response:
+            record_class_latency(config, request_class, time.time() - start_time)
+            return response, True
+        if emitted:
+            # Часть ответа уже озвучивается - другого провайдера не подключаем
+            return ' '.join(emitted), False
+    
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Все настроенные провайдеры не ответили (потоковый режим)", file=sys.stderr)
+    return None, False
+
+def generate_response(
+    text: str,
+    config: BotConfig,
+    session: requests.Session,
+    history: Optional[List[Dict]] = None,
+    request_class: Optional[str] = None
+) -> Optional[str]:
+    """
+    Генерирует ответ используя провайдеры в порядке приоритета:
+    реестр providers, затем ZenMux (основная + запасные модели) -> OpenRouter -> OpenAI -> Groq.
+    request_class (classify_request) выбирает цепочку класса: его модели первыми и его лимит токенов.
+    С adaptive_routing порядок выбирает ROUTER по задержке и доле успешных ответов.
+    С llm_hedging провайдеры запрашиваются с перекрытием (generate_response_hedged)
+    """
+    providers = provider_chain(config, request_class)
+    start_time = time.time()
+    if not providers:
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Нет настроенных провайдеров! Добавьте API ключи в telegram_config.json", file=sys.stderr)
+        return None
     
+    if config.llm_hedging and len(providers) > 1:
+        response = generate_response_hedged(text, providers, session, config.personality, config.hedge_delay, config.hedge_max_parallel, history)
+        if response:
+            record_class_latency(config, request_class, time.time() - start_time)
+            return response
+    else:
+        for i, provider_config in enumerate(providers):
+            if i == 0:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🤖 Пробую {provider_config['name']}: {provider_config['model']}", file=sys.stderr)
+            else:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 {providers[i - 1]['name']} ({providers[i - 1]['model']}) не ответил, пробую {provider_config['name']}: {provider_config['model']}", file=sys.stderr)
+            response = generate_response_with_provider(text, provider_config, session, config.personality, history=history)
+            if response:
+                if i > 0:
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ {provider_config['name']} ({provider_config['model']}) сработал!", file=sys.stderr)
+                record_class_latency(config, request_class, time.time() - start_time)
+                return response
+    
+    available_providers = list(dict.fromkeys(p['name'] for p in providers))
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Все настроенные провайдеры не ответили: {', '.join(available_providers)}", file=sys.stderr)
     return None
 
 def cleanup_old_audio_files(max_files: int = AUDIO_MAX_FILES):
@@ -345,9 +1755,10 @@ def cleanup_temp_voice_files():
     if deleted_count > 0:
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 🗑️ Удалено {deleted_count} старых временных голосовых файлов", file=sys.stderr)
 
-def generate_audio(text: str) -> Optional[str]:
-    """Генерирует аудио через text_to_speech.py"""
+def generate_audio(text: str, voice_id: Optional[str] = None) -> Optional[str]:
+    """Генерирует аудио через text_to_speech.py (voice_id - голос конкретного чата)"""
     before_time = time.time()
+    env = dict(os.environ, MINIMAX_VOICE_ID=voice_id) if voice_id else None
     
     try:
         process = subprocess.Popen(
@@ -357,9 +1768,17 @@ def generate_audio(text: str) -> Optional[str]:
             stderr=subprocess.PIPE,
             text=True,
             encoding='utf-8',
-            errors='replace'
+            errors='replace',
+            env=env
         )
-        stdout, stderr = process.communicate(input=text, timeout=120)
+        try:
+            stdout, stderr = process.communicate(input=text, timeout=stage_timeout(120))
+        except subprocess.TimeoutExpired:
+            # communicate не завершает процесс сам: иначе он продолжит работать после таймаута стадии
+            process.kill()
+            process.communicate()
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Таймаут генерации аудио", file=sys.stderr)
+            return None
         
         if process.returncode != 0:
             print(f"Ошибка при генерации аудио:\n{stderr}", file=sys.stderr)
@@ -372,7 +1791,6 @@ def generate_audio(text: str) -> Optional[str]:
                 break
         
         if not audio_file:
-            time.sleep(0.5)
             audio_dir = "audio"
             if os.path.exists(audio_dir):
                 mp3_files = glob.glob(f"{audio_dir}/*.mp3")
@@ -391,16 +1809,23 @@ def generate_audio(text: str) -> Optional[str]:
         print(f"Ошибка при генерации аудио: {e}", file=sys.stderr)
         return None
 
-def convert_mp3_to_ogg(mp3_path: str) -> str:
-    """Конвертирует MP3 в OGG для Telegram (если нужно)"""
-    ogg_path = mp3_path.replace('.mp3', '.ogg')
-    
+@lru_cache(maxsize=1)
+def has_ffmpeg() -> bool:
+    """Проверяет наличие FFmpeg (один раз за время работы)"""
     try:
         subprocess.run(['ffmpeg', '-version'], 
                      stdout=subprocess.PIPE, 
                      stderr=subprocess.PIPE, 
                      timeout=5)
+        return True
     except (FileNotFoundError, subprocess.TimeoutExpired):
+        return False
+
+def convert_mp3_to_ogg(mp3_path: str) -> str:
+    """Конвертирует MP3 в OGG для Telegram (если нужно)"""
+    ogg_path = mp3_path.replace('.mp3', '.ogg')
+    
+    if not has_ffmpeg():
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ FFmpeg не найден, отправляю MP3 напрямую", file=sys.stderr)
         return mp3_path
     
@@ -411,16 +1836,19 @@ def convert_mp3_to_ogg(mp3_path: str) -> str:
             '-b:a', '64k',
             ogg_path,
             '-y'
-        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=stage_timeout(30))
         return ogg_path
     except Exception as e:
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Ошибка при конвертации в OGG: {e}, отправляю MP3", file=sys.stderr)
         return mp3_path
 
-def send_voice_message(bot_token: str, chat_id: str, audio_path: str, session: requests.Session) -> bool:
-    """Отправляет голосовое сообщение в Telegram"""
+def send_voice_message(bot_token: str, chat_id: str, audio_path: str, session: requests.Session) -> Optional[int]:
+    """Отправляет голосовое сообщение в Telegram (с конвертацией в OGG)"""
+    return upload_voice(bot_token, chat_id, convert_mp3_to_ogg(audio_path), session)
+
+def upload_voice(bot_token: str, chat_id: str, audio_path: str, session: requests.Session) -> Optional[int]:
+    """Загружает готовый аудиофайл в Telegram через sendVoice. Возвращает message_id отправленного сообщения"""
     url = f"https://api.telegram.org/bot{bot_token}/sendVoice"
-    audio_path = convert_mp3_to_ogg(audio_path)
     
     try:
         with open(audio_path, 'rb') as audio_file:
@@ -431,16 +1859,20 @@ def send_voice_message(bot_token: str, chat_id: str, audio_path: str, session: r
             result = response.json()
             
             if result.get('ok'):
-                return True
+                return result.get('result', {}).get('message_id')
             else:
                 print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка Telegram API: {result.get('description')}", file=sys.stderr)
-                return False
+                return None
     except Exception as e:
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка при отправке: {e}", file=sys.stderr)
-        return False
+        return None
 
 def should_respond(message: dict, bot_username: Optional[str] = None) -> bool:
     """Определяет, должен ли бот ответить на сообщение"""
+    return bool(respond_trigger(message, bot_username))
+
+def respond_trigger(message: dict, bot_username: Optional[str] = None) -> Optional[str]:
+    """Причина ответа: reply, voice, mention, question или keyword (None - не отвечать)"""
     # Проверяем reply на сообщение бота
     if message.get('reply_to_message'):
         reply = message['reply_to_message']
@@ -448,14 +1880,14 @@ def should_respond(message: dict, bot_username: Optional[str] = None) -> bool:
         if reply_from.get('is_bot'):
             if not bot_username or reply_from.get('username') == bot_username:
                 print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ should_respond: True (reply на бота)", file=sys.stderr)
-                return True
+                return 'reply'
     
     text = message.get('text', '') or message.get('caption', '')
     
     # Если это было голосовое сообщение (помечено после транскрипции) - всегда отвечаем
     if message.get('_was_voice'):
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ should_respond: True (было голосовое сообщение)", file=sys.stderr)
-        return True
+        return 'voice'
     
     # Если нет текста, но есть голосовое сообщение - нужно транскрибировать сначала
     # (это обрабатывается в process_updates до вызова should_respond)
@@ -467,32 +1899,50 @@ def should_respond(message: dict, bot_username: Optional[str] = None) -> bool:
             reply_from = reply.get('from', {})
             if reply_from.get('is_bot'):
                 if not bot_username or reply_from.get('username') == bot_username:
-                    return True
+                    return 'reply'
         # Для остальных голосовых сообщений - транскрибируем и проверим текст после
         # Возвращаем True, чтобы транскрибировать, а потом проверим транскрибированный текст
-        return True
+        return 'voice'
     
     # Проверяем упоминание бота
     if text and bot_username and f'@{bot_username}' in text:
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ should_respond: True (упоминание @{bot_username})", file=sys.stderr)
-        return True
+        return 'mention'
     
     # Проверяем текст на вопросы и обращения
     if text:
         text_lower = text.lower()
         if '?' in text:
             print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ should_respond: True (есть вопрос '?')", file=sys.stderr)
-            return True
+            return 'question'
         keywords = ['бот', 'помоги', 'расскажи', 'объясни', 'скажи']
         found_keywords = [word for word in keywords if word in text_lower]
         if found_keywords:
             print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ should_respond: True (найдены ключевые слова: {found_keywords})", file=sys.stderr)
-            return True
+            return 'keyword'
     
     print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ should_respond: False (не подходит ни под одно условие)", file=sys.stderr)
     print(f"[{datetime.now().strftime('%H:%M:%S')}]    Текст: '{text[:50]}...'", file=sys.stderr)
     print(f"[{datetime.now().strftime('%H:%M:%S')}]    Bot username: {bot_username}", file=sys.stderr)
-    return False
+    return None
+
+def download_and_transcribe(file_id: str, config: 'BotConfig', session: requests.Session) -> Optional[str]:
+    """Скачивает голосовое сообщение, транскрибирует его и удаляет временный файл"""
+    voice_file = download_voice_file(config.bot_token, file_id, session)
+    if not voice_file:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Не удалось скачать голосовое сообщение", file=sys.stderr)
+        return None
+    
+    # Транскрибируем голосовое сообщение (пробуем разные сервисы)
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎙️ Начинаю транскрипцию голосового сообщения...", file=sys.stderr)
+    try:
+        return transcribe_voice(voice_file, config, session)
+    finally:
+        # Удаляем временный файл
+        try:
+            os.remove(voice_file)
+        except:
+            pass
 
 def download_voice_file(bot_token: str, file_id: str, session: requests.Session) -> Optional[str]:
     """Скачивает голосовой файл из Telegram и возвращает путь к файлу"""
@@ -522,7 +1972,8 @@ def download_voice_file(bot_token: str, file_id: str, session: requests.Session)
         
         # Определяем расширение файла
         ext = os.path.splitext(file_path)[1] or '.ogg'
-        temp_file = os.path.join(temp_dir, f"voice_{int(time.time())}{ext}")
+        # file_id в имени: несколько голосовых могут скачиваться одновременно
+        temp_file = os.path.join(temp_dir, f"voice_{int(time.time())}_{file_id[-16:]}{ext}")
         
         with open(temp_file, 'wb') as f:
             f.write(download_response.content)
@@ -563,20 +2014,7 @@ def transcribe_voice_with_huggingface(audio_file_path: str, session: requests.Se
                     timeout=60
                 )
                 
-                if response.status_code == 503:
-                    # Модель загружается, ждем немного
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏳ Модель {model} загружается, жду...", file=sys.stderr)
-                    time.sleep(10)  # Увеличиваем время ожидания
-                    # Повторяем запрос
-                    audio_file.seek(0)
-                    response = session.post(
-                        url,
-                        files={'file': audio_file},
-                        data={'language': 'russian'},
-                        headers=headers,
-                        timeout=60
-                    )
-                
+                # 503 (модель загружается) не ждём: сразу пробуем следующую модель (см. обработку HTTPError)
                 if response.status_code == 410:
                     # Модель недоступна, пробуем следующую
                     print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Модель {model} недоступна (410), пробую следующую...", file=sys.stderr)
@@ -721,10 +2159,12 @@ def transcribe_voice_with_assemblyai(audio_file_path: str, api_key: str, session
             if not transcript_id:
                 return None
             
-            # Ждем завершения транскрипции (polling)
+            # Ждем завершения транскрипции (polling: короткие сообщения готовы быстро,
+            # поэтому начинаем с маленького интервала и постепенно его увеличиваем)
             polling_url = f"https://api.assemblyai.com/v2/transcript/{transcript_id}"
-            max_attempts = 30
-            for attempt in range(max_attempts):
+            deadline = time.monotonic() + stage_timeout(60)
+            poll_interval = 0.3
+            while time.monotonic() < deadline:
                 polling_response = session.get(polling_url, headers=headers, timeout=60)
                 polling_response.raise_for_status()
                 polling_data = polling_response.json()
@@ -740,7 +2180,8 @@ def transcribe_voice_with_assemblyai(audio_file_path: str, api_key: str, session
                     print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ AssemblyAI ошибка: {error}", file=sys.stderr)
                     return None
                 
-                time.sleep(1)
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 1.5, 2.0)
             
             print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ AssemblyAI: таймаут ожидания транскрипции", file=sys.stderr)
             return None
@@ -812,11 +2253,12 @@ def transcribe_voice_with_lemonfox(audio_file_path: str, api_key: str, session:
         return None
 
 def transcribe_voice(audio_file_path: str, config: BotConfig, session: requests.Session) -> Optional[str]:
-    """Транскрибирует голосовое сообщение, пробуя разные сервисы в порядке приоритета"""
+    """Транскрибирует голосовое сообщение, пробуя разные сервисы в порядке приоритета
+    (сервисы с разомкнутым circuit breaker пропускаются)"""
     # 1. Пробуем OpenAI (если доступен)
     if config.has_openai():
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎙️ Пробую транскрипцию через OpenAI Whisper...", file=sys.stderr)
-        result = transcribe_voice_with_openai(audio_file_path, config.openai_api_key, session)
+        result = call_with_breaker('asr:openai', transcribe_voice_with_openai, audio_file_path, config.openai_api_key, session)
         if result:
             return result
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ OpenAI не сработал, пробую альтернативный сервис...", file=sys.stderr)
@@ -824,7 +2266,7 @@ def transcribe_voice(audio_file_path: str, config: BotConfig, session: requests.
     # 2. Пробуем AssemblyAI (если есть ключ)
     if config.has_assemblyai():
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎙️ Пробую транскрипцию через AssemblyAI...", file=sys.stderr)
-        result = transcribe_voice_with_assemblyai(audio_file_path, config.assemblyai_api_key, session)
+        result = call_with_breaker('asr:assemblyai', transcribe_voice_with_assemblyai, audio_file_path, config.assemblyai_api_key, session)
         if result:
             return result
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ AssemblyAI не сработал, пробую следующий сервис...", file=sys.stderr)
@@ -832,7 +2274,7 @@ def transcribe_voice(audio_file_path: str, config: BotConfig, session: requests.
     # 3. Пробуем Deepgram (если есть ключ)
     if config.has_deepgram():
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎙️ Пробую транскрипцию через Deepgram...", file=sys.stderr)
-        result = transcribe_voice_with_deepgram(audio_file_path, config.deepgram_api_key, session)
+        result = call_with_breaker('asr:deepgram', transcribe_voice_with_deepgram, audio_file_path, config.deepgram_api_key, session)
         if result:
             return result
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Deepgram не сработал, пробую следующий сервис...", file=sys.stderr)
@@ -840,14 +2282,14 @@ def transcribe_voice(audio_file_path: str, config: BotConfig, session: requests.
     # 4. Пробуем Lemonfox.ai (если есть ключ)
     if config.has_lemonfox():
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎙️ Пробую транскрипцию через Lemonfox.ai...", file=sys.stderr)
-        result = transcribe_voice_with_lemonfox(audio_file_path, config.lemonfox_api_key, session)
+        result = call_with_breaker('asr:lemonfox', transcribe_voice_with_lemonfox, audio_file_path, config.lemonfox_api_key, session)
         if result:
             return result
         print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Lemonfox не сработал, пробую следующий сервис...", file=sys.stderr)
     
     # 5. Пробуем Hugging Face (бесплатно, без ключа)
     print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎙️ Пробую транскрипцию через Hugging Face (бесплатно)...", file=sys.stderr)
-    result = transcribe_voice_with_huggingface(audio_file_path, session)
+    result = call_with_breaker('asr:huggingface', transcribe_voice_with_huggingface, audio_file_path, session)
     if result:
         return result
     
@@ -867,12 +2309,51 @@ def get_bot_info(bot_token: str, session: requests.Session) -> Optional[dict]:
         print(f"Ошибка при получении информации о боте: {e}", file=sys.stderr)
     return None
 
+def set_webhook(bot: 'TelegramBot', session: requests.Session) -> bool:
+    """Регистрирует webhook бота в Telegram с секретным токеном"""
+    url = f"https://api.telegram.org/bot{bot.token}/setWebhook"
+    data = {
+        'url': bot.webhook_url,
+        'secret_token': bot.config.webhook_secret,
+        'max_connections': bot.config.max_concurrency * 2,
+        'allowed_updates': HANDLED_UPDATE_TYPES
+    }
+    try:
+        response = session.post(url, json=data, timeout=10)
+        result = response.json()
+        if result.get('ok'):
+            return True
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Не удалось установить webhook: {result.get('description')}", file=sys.stderr)
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка при установке webhook: {e}", file=sys.stderr)
+    return False
+
+def delete_webhook(bot_token: str, session: requests.Session) -> bool:
+    """Удаляет webhook (бот снова может получать обновления через getUpdates)"""
+    url = f"https://api.telegram.org/bot{bot_token}/deleteWebhook"
+    try:
+        response = session.post(url, timeout=10)
+        return response.status_code == 200 and response.json().get('ok', False)
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Ошибка при удалении webhook: {e}", file=sys.stderr)
+        return False
+
 class UpdateManager:
-    """Класс для управления last_update_id с оптимизацией записи"""
-    def __init__(self, file_path: str = LAST_UPDATE_ID_FILE):
+    """Класс для управления last_update_id: значение держится в памяти,
+    на диск сохраняется атомарно (temp + fsync + rename) раз в N обновлений или по таймеру"""
+    def __init__(
+        self,
+        file_path: str = LAST_UPDATE_ID_FILE,
+        checkpoint_every: int = OFFSET_CHECKPOINT_EVERY,
+        checkpoint_interval: float = OFFSET_CHECKPOINT_INTERVAL
+    ):
         self.file_path = file_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
         self.last_update_id = 0
+        self.saved_update_id = 0
         self.pending_write = False
+        self.last_checkpoint_time = time.time()
         self.load()
     
     def load(self):
@@ -881,145 +2362,936 @@ class UpdateManager:
             try:
                 with open(self.file_path, 'r') as f:
                     self.last_update_id = int(f.read().strip())
+                    self.saved_update_id = self.last_update_id
             except:
                 pass
     
     def update(self, update_id: int):
-        """Обновляет last_update_id (записывает в файл только если изменился)"""
+        """Обновляет last_update_id в памяти и при необходимости сохраняет на диск"""
         if update_id > self.last_update_id:
             self.last_update_id = update_id
+            self.pending_write = True
+        self.maybe_checkpoint()
+    
+    def maybe_checkpoint(self):
+        """Сохраняет, если накопилось checkpoint_every обновлений или прошло checkpoint_interval секунд"""
+        if not self.pending_write:
+            return
+        if (self.last_update_id - self.saved_update_id >= self.checkpoint_every
+                or time.time() - self.last_checkpoint_time >= self.checkpoint_interval):
+            self.checkpoint()
+    
+    def checkpoint(self):
+        """Атомарно записывает last_update_id: временный файл + fsync + rename"""
+        if not self.pending_write:
+            return
+        started = time.perf_counter()
+        try:
+            atomic_write(self.file_path, str(self.last_update_id))
+            self.saved_update_id = self.last_update_id
+            self.pending_write = False
+        except Exception as e:
+            print(f"Ошибка при записи last_update_id: {e}", file=sys.stderr)
+        self.last_checkpoint_time = time.time()
+        METRICS.observe('offset_checkpoint', time.perf_counter() - started)
+
+
+class UpdateLedger:
+    """Журнал обновлений в SQLite (WAL) для доставки at-least-once.
+    Каждое сообщение проходит состояния received -> processing -> done (или failed),
+    неотправленные ответы (retry) повторяются по таймеру, незавершённые после падения
+    процесса обрабатываются заново при запуске, если они не старше LEDGER_MAX_AGE.
+    Таблица replies хранит ключи идемпотентности отправленных ответов.
+    Методы блокирующие: из цикла событий вызываются через run_blocking"""
+    def __init__(self, file_path: str = UPDATE_LEDGER_FILE, default_bot_id: str = ''):
+        # Одно соединение на процесс: транзакции из разных потоков не должны перемежаться
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # update_id уникален только в пределах бота: записи старой схемы без bot_id
+        # переносим как записи основного бота (default_bot_id)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(updates)")]
+        if columns and 'bot_id' not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE updates RENAME TO updates_old")
+                self.conn.execute("DROP INDEX IF EXISTS updates_state")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS updates (
+                bot_id TEXT NOT NULL DEFAULT '',
+                update_id INTEGER NOT NULL,
+                chat_id TEXT,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (bot_id, update_id)
+            );
+            CREATE INDEX IF NOT EXISTS updates_state ON updates(state);
+            CREATE TABLE IF NOT EXISTS replies (
+                idempotency_key TEXT PRIMARY KEY,
+                update_id INTEGER,
+                sent_at REAL NOT NULL
+            );
+        """)
+        if columns and 'bot_id' not in columns:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO updates (bot_id, update_id, chat_id, payload, state, attempts, updated_at) "
+                    "SELECT ?, update_id, chat_id, payload, state, attempts, updated_at FROM updates_old",
+                    (default_bot_id,)
+                )
+                self.conn.execute("DROP TABLE updates_old")
+        self.conn.commit()
+    
+    def record_batch(self, messages: List[dict]) -> List[dict]:
+        """Записывает пачку полученных сообщений одной транзакцией, возвращает только новые"""
+        now = time.time()
+        new_messages = []
+        with self.lock, self.conn:
+            for m in messages:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO updates (bot_id, update_id, chat_id, payload, state, updated_at) VALUES (?, ?, ?, ?, 'received', ?)",
+                    (m.get('_bot_id', ''), m['_update_id'], str(m.get('chat', {}).get('id', '')), json.dumps(m, ensure_ascii=False), now)
+                )
+                if cursor.rowcount:
+                    new_messages.append(m)
+        return new_messages
+    
+    def mark(self, bot_id: str, update_id: int, state: str):
+        """Меняет состояние сообщения. retry - ответ не отправлен: сообщение ждёт повтора
+        (due_retries), а после LEDGER_MAX_ATTEMPTS попыток - failed"""
+        with self.lock, self.conn:
+            if state == 'processing':
+                self.conn.execute("UPDATE updates SET state = ?, attempts = attempts + 1, updated_at = ? WHERE bot_id = ? AND update_id = ?", (state, time.time(), bot_id, update_id))
+            elif state == 'retry':
+                self.conn.execute(
+                    "UPDATE updates SET state = CASE WHEN attempts < ? THEN 'retry' ELSE 'failed' END, updated_at = ? WHERE bot_id = ? AND update_id = ?",
+                    (LEDGER_MAX_ATTEMPTS, time.time(), bot_id, update_id)
+                )
+            else:
+                self.conn.execute("UPDATE updates SET state = ?, updated_at = ? WHERE bot_id = ? AND update_id = ?", (state, time.time(), bot_id, update_id))
+    
+    def unfinished(self, max_age: float = LEDGER_MAX_AGE) -> List[dict]:
+        """Сообщения, обработка которых не завершилась (с ограничением числа попыток).
+        Более старые, чем max_age секунд, помечаются failed: отвечать на них поздно"""
+        cutoff = time.time() - max_age
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE updates SET state = 'failed' WHERE state IN ('received', 'processing', 'retry') AND updated_at < ?", (cutoff,))
+            rows = self.conn.execute(
+                "SELECT payload FROM updates WHERE state IN ('received', 'processing', 'retry') AND attempts < ? ORDER BY bot_id, update_id",
+                (LEDGER_MAX_ATTEMPTS,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def due_retries(self, delay: float = LEDGER_RETRY_DELAY, max_age: float = LEDGER_MAX_AGE) -> List[dict]:
+        """Сообщения, ответ на которые не отправился не меньше delay секунд назад: они снова
+        received и возвращаются для повторной обработки. Старше max_age - failed"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE updates SET state = 'failed' WHERE state = 'retry' AND updated_at < ?", (now - max_age,))
+            rows = self.conn.execute(
+                "SELECT bot_id, update_id, payload FROM updates WHERE state = 'retry' AND updated_at <= ? ORDER BY bot_id, update_id",
+                (now - delay,)
+            ).fetchall()
+            self.conn.executemany("UPDATE updates SET state = 'received', updated_at = ? WHERE bot_id = ? AND update_id = ?", [(now, bot_id, update_id) for bot_id, update_id, _ in rows])
+        return [json.loads(row[2]) for row in rows]
+    
+    def already_replied(self, key: str) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM replies WHERE idempotency_key = ?", (key,)).fetchone() is not None
+    
+    def record_reply(self, key: str, update_id: Optional[int]):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO replies (idempotency_key, update_id, sent_at) VALUES (?, ?, ?)", (key, update_id, time.time()))
+    
+    def prune(self, days: int = LEDGER_RETENTION_DAYS):
+        """Удаляет старые завершённые записи, чтобы база не разрасталась"""
+        cutoff = time.time() - days * 86400
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM updates WHERE state IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+            self.conn.execute("DELETE FROM replies WHERE sent_at < ?", (cutoff,))
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def reply_key(message: dict) -> str:
+    """Ключ идемпотентности ответа: один ответ бота на одно сообщение чата"""
+    return f"{message.get('_bot_id', '')}:{message.get('chat', {}).get('id', '')}:{message.get('message_id', message.get('_update_id'))}"
+
+async def run_blocking(func, *args, executor: Optional[ThreadPoolExecutor] = None, **kwargs):
+    """Выполняет блокирующую функцию в пуле потоков (по умолчанию - общем пуле цикла событий)
+    и возвращает awaitable результат"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+class StageRejected(Exception):
+    """Задача не принята стадией (очередь переполнена) или вытеснена из очереди"""
+
+class Stage:
+    """Стадия обработки: ограниченная очередь + фиксированное число воркеров.
+    Блокирующие функции выполняются в собственном пуле потоков стадии (по потоку на воркер)
+    с таймаутом на задачу: срок передаётся и в сами вызовы (stage_timeout), поэтому
+    зависший вызов занимает поток только своей стадии и недолго.
+    В метрики пишутся глубина очереди и время обслуживания."""
+    def __init__(self, name: str, workers: int, timeout: float, queue_size: int, policy: str = 'block'):
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.policy = policy
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        self.executor: Optional[ThreadPoolExecutor] = None
+    
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'stage-{self.name}')
+        self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.workers)]
+    
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+    
+    async def run(self, func, *args, **kwargs):
+        """Ставит вызов в очередь стадии и ждёт результат"""
+        future = asyncio.get_running_loop().create_future()
+        job = (partial(func, *args, **kwargs), future)
+        if self.queue.full():
+            if self.policy == 'reject':
+                METRICS.inc(f'stage.{self.name}.rejected')
+                raise StageRejected(f"стадия {self.name} перегружена")
+            if self.policy == 'drop_oldest':
+                _, dropped = self.queue.get_nowait()
+                if not dropped.done():
+                    dropped.set_exception(StageRejected(f"задача вытеснена из очереди стадии {self.name}"))
+                METRICS.inc(f'stage.{self.name}.dropped')
+        await self.queue.put(job)
+        METRICS.gauge(f'stage.{self.name}.queue', self.queue.qsize())
+        return await future
+    
+    async def worker(self):
+        while True:
+            call, future = await self.queue.get()
+            METRICS.gauge(f'stage.{self.name}.queue', self.queue.qsize())
+            if future.done():
+                continue
+            started = time.perf_counter()
             try:
-                with open(self.file_path, 'w') as f:
-                    f.write(str(self.last_update_id))
+                deadline = time.monotonic() + self.timeout
+                result = await asyncio.wait_for(run_blocking(run_with_deadline, deadline, call, executor=self.executor), timeout=self.timeout)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.TimeoutError:
+                METRICS.inc(f'stage.{self.name}.timeout')
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Стадия {self.name}: таймаут {self.timeout} сек", file=sys.stderr)
+                if not future.done():
+                    future.set_result(None)
             except Exception as e:
-                print(f"Ошибка при записи last_update_id: {e}", file=sys.stderr)
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                METRICS.observe(f'stage.{self.name}', time.perf_counter() - started)
 
-def process_updates(config: BotConfig, bot_username: Optional[str], session: requests.Session):
-    """Обрабатывает обновления от Telegram"""
-    url = f"https://api.telegram.org/bot{config.bot_token}/getUpdates"
-    update_manager = UpdateManager()
+class Pipeline:
+    """Набор стадий обработки сообщения: asr -> llm -> tts -> encode -> send"""
+    def __init__(self, stage_configs: Dict[str, dict]):
+        self.stages = {
+            name: Stage(name, max(1, int(cfg['workers'])), float(cfg['timeout']), max(1, int(cfg['queue_size'])), cfg.get('policy', 'block'))
+            for name, cfg in stage_configs.items()
+        }
+    
+    def start(self):
+        for stage in self.stages.values():
+            stage.start()
+    
+    def stop(self):
+        for stage in self.stages.values():
+            stage.stop()
+    
+    async def run(self, stage_name: str, func, *args, **kwargs):
+        return await self.stages[stage_name].run(func, *args, **kwargs)
+
+async def handle_message(message: dict, engine: 'BotEngine'):
+    """Обрабатывает одно сообщение: транскрипция -> should_respond -> AI -> TTS -> OGG -> отправка.
+    Каждый тяжёлый шаг выполняется в своей стадии конвейера (engine.pipeline),
+    настройки (личность, голос, провайдеры) берутся из конфигурации чата.
+    Возвращает True, если сообщение обработано (ответ отправлен или не нужен),
+    False - ответ нужен, но не отправлен (сообщение можно обработать повторно)"""
+    bot = engine.bots[message['_bot_id']]
+    chat_id = message.get('chat', {}).get('id')
+    config = bot.config.for_chat(chat_id) or bot.config
+    session = engine.session
+    ledger = engine.ledger
+    pipeline = engine.pipeline
+    idempotency_key = reply_key(message)
+    if ledger and await run_blocking(ledger.already_replied, idempotency_key):
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏭️ На сообщение {idempotency_key} уже был отправлен ответ (пропускаю)", file=sys.stderr)
+        return True
     
+    # Проверяем голосовое сообщение
+    voice = message.get('voice')
+    audio = message.get('audio')
+    text = message.get('text', '') or message.get('caption', '')
+    
+    # Если есть голосовое сообщение, транскрибируем его СНАЧАЛА
+    if voice or audio:
+        file_id = voice.get('file_id') if voice else audio.get('file_id')
+        if file_id:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎤 Получено голосовое сообщение, начинаю транскрипцию...", file=sys.stderr)
+            # file_unique_id одинаков для всех ботов: транскрипция переиспользуется между чатами
+            unique_id = (voice or audio).get('file_unique_id')
+            transcribed_text = engine.asr_cache.get(unique_id) if unique_id else None
+            if transcribed_text:
+                METRICS.inc('cache.asr.hit')
+            else:
+                # Один и тот же файл (пересланное голосовое) транскрибируется один раз
+                transcribed_text = await engine.asr_flight.do(
+                    unique_id or file_id, pipeline.run, 'asr', download_and_transcribe, file_id, config, session
+                )
+                if transcribed_text and unique_id:
+                    engine.asr_cache.set(unique_id, transcribed_text)
+            
+            if transcribed_text:
+                text = transcribed_text
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Транскрибировано: {text[:100]}...", file=sys.stderr)
+                # Обновляем сообщение с транскрибированным текстом для проверки should_respond
+                message['text'] = transcribed_text
+                # Помечаем, что это было голосовое сообщение (для should_respond)
+                message['_was_voice'] = True
+                # Удаляем voice/audio из сообщения, чтобы should_respond проверял только текст
+                if 'voice' in message:
+                    del message['voice']
+                if 'audio' in message:
+                    del message['audio']
+            else:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Не удалось транскрибировать голосовое сообщение", file=sys.stderr)
+                print(f"[{datetime.now().strftime('%H:%M:%S')}]    Попробуйте отправить текстовое сообщение", file=sys.stderr)
+                return False
+    
+    if text:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 📥 Новое сообщение в чате: {text[:100]}...", file=sys.stderr)
+    
+    # Проверяем, нужно ли отвечать (после транскрипции, если было голосовое)
+    trigger = respond_trigger(message, bot.username)
+    if not trigger:
+        if text:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏭️ Пропускаю (не подходит под условия ответа)", file=sys.stderr)
+        return True
+    
+    if not text:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Сообщение без текста - пропускаю", file=sys.stderr)
+        return True
+    
+    print(f"\n[{datetime.now().strftime('%H:%M:%S')}] ✅ БОТ БУДЕТ ОТВЕЧАТЬ на сообщение: {text[:50]}...", file=sys.stderr)
+    
+    # Короткие реплики - быстрой модели, сложные вопросы - большой (request_classes)
+    request_class = classify_request(text, trigger, config) if config.request_routing else None
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🤖 Генерирую ответ через AI... (класс запроса: {request_class or 'без классов'})", file=sys.stderr)
+    # После ошибок AI следующие запросы придерживаются (backoff), в норме идут сразу
+    memory_key = (bot.bot_id, str(chat_id))
+    reply_to = (message.get('reply_to_message') or {}).get('message_id')
+    history = []
+    if config.memory_scope != 'off':
+        history = engine.memory.history(memory_key, reply_to, config.memory_token_budget, config.memory_scope == 'chat')
+    # Ответ с учётом истории диалога не кэшируется: он зависит не только от текста
+    cache_key = ResponseCache.key(text, config, request_class) if config.response_cache and not history else None
+    response_text = engine.response_cache.get(cache_key) if cache_key else None
+    streamed = sent = False
+    complete = True
+    sent_ids = []
+    if response_text:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 💾 Ответ взят из кэша", file=sys.stderr)
+    elif config.stream_responses:
+        await engine.llm_backoff.wait()
+        response_text, sent_ids, sent, complete = await stream_reply(engine, bot, config, chat_id, text, history, request_class)
+        streamed = True
+    else:
+        await engine.llm_backoff.wait()
+        # Одинаковые одновременные вопросы (с той же личностью, классом, моделями и историей) - один запрос к AI
+        flight_key = ResponseCache.key(text, config, request_class) + json.dumps(history, ensure_ascii=False)
+        response_text = await engine.llm_flight.do(flight_key, pipeline.run, 'llm', generate_response, text, config, session, history, request_class)
+    # Оборванный поток - только часть ответа: в кэш не попадает
+    if response_text and cache_key and complete:
+        engine.response_cache.set(cache_key, response_text)
+    
+    if not response_text:
+        delay = engine.llm_backoff.failure()
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ AI не смог сгенерировать ответ", file=sys.stderr)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}]    Возможные причины: превышен лимит запросов, ошибка API, или модель не ответила", file=sys.stderr)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}]    Следующий запрос к AI не раньше чем через {delay:.1f} сек", file=sys.stderr)
+        return False
+    engine.llm_backoff.success()
+    
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Ответ сгенерирован: {response_text[:50]}...", file=sys.stderr)
+    
+    if not streamed:
+        voice_file = await prepare_voice(engine, config, response_text)
+        if not voice_file:
+            return False
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 📤 Отправляю голосовое сообщение...", file=sys.stderr)
+        sent_id = await pipeline.run('send', upload_voice, bot.token, chat_id, voice_file, session)
+        sent = bool(sent_id)
+        sent_ids = [sent_id] if sent_id else []
+    
+    if sent_ids:
+        engine.memory.add(memory_key, 'user', text, [message['message_id']] if message.get('message_id') else [], reply_to)
+        engine.memory.add(memory_key, 'assistant', response_text, sent_ids, message.get('message_id'))
+    if sent:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Голосовое сообщение успешно отправлено!", file=sys.stderr)
+    else:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка при отправке голосового сообщения", file=sys.stderr)
+    # Часть потокового ответа уже в чате: повторная обработка отправила бы её ещё раз
+    if sent_ids and ledger:
+        await run_blocking(ledger.record_reply, idempotency_key, message.get('_update_id'))
+    return bool(sent_ids)
+
+async def prepare_voice(engine: 'BotEngine', config: BotConfig, text: str) -> Optional[str]:
+    """TTS (с кэшем по голосу и тексту) и конвертация в OGG. Возвращает файл для отправки.
+    Одновременные запросы с тем же голосом и текстом ждут один синтез"""
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎤 Создаю голосовое сообщение...", file=sys.stderr)
+    tts_key = (config.voice_id, text)
+    return await engine.tts_flight.do(tts_key, synthesize_voice, engine, tts_key)
+
+async def synthesize_voice(engine: 'BotEngine', tts_key: Tuple[Optional[str], str]) -> Optional[str]:
+    voice_id, text = tts_key
+    audio_file = engine.tts_cache.get(tts_key)
+    if audio_file and os.path.exists(audio_file):
+        METRICS.inc('cache.tts.hit')
+    else:
+        audio_file = await engine.pipeline.run('tts', generate_audio, text, voice_id)
+        if audio_file:
+            engine.tts_cache.set(tts_key, audio_file)
+    if not audio_file:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Не удалось создать аудио", file=sys.stderr)
+        return None
+    return await engine.pipeline.run('encode', convert_mp3_to_ogg, audio_file) or audio_file
+
+async def stream_reply(
+    engine: 'BotEngine',
+    bot: 'TelegramBot',
+    config: BotConfig,
+    chat_id,
+    text: str,
+    history: Optional[List[Dict]] = None,
+    request_class: Optional[str] = None
+) -> Tuple[Optional[str], List[int], bool, bool]:
+    """Потоковый ответ: AI генерирует текст в стадии llm, каждое готовое предложение
+    сразу уходит в TTS, голосовые сообщения отправляются строго по порядку предложений.
+    Возвращает (текст ответа, message_id отправленных голосовых, отправлены ли все без ошибок,
+    полный ли ответ - False, если поток оборвался или стадия llm не дождалась его конца)"""
+    loop = asyncio.get_running_loop()
+    voices: asyncio.Queue = asyncio.Queue()
+    closed = False
+    
+    def enqueue(sentence: str):
+        # Предложения после таймаута стадии llm уже никто не отправит - не озвучиваем их
+        if not closed:
+            voices.put_nowait(asyncio.ensure_future(prepare_voice(engine, config, sentence)))
+    
+    def on_sentence(sentence: str):
+        # Вызывается из потока стадии llm
+        loop.call_soon_threadsafe(enqueue, sentence)
+    
+    sent_ids = []
+    
+    async def send_in_order() -> bool:
+        failed = False
+        while True:
+            task = await voices.get()
+            if task is None:
+                return bool(sent_ids) and not failed
+            voice_file = await task
+            sent_id = await engine.pipeline.run('send', upload_voice, bot.token, chat_id, voice_file, engine.session) if voice_file else None
+            if sent_id:
+                sent_ids.append(sent_id)
+            else:
+                failed = True
+    
+    sender = asyncio.ensure_future(send_in_order())
     try:
-        params = {'offset': update_manager.last_update_id + 1, 'timeout': 30}
-        response = session.get(url, params=params, timeout=35)
+        # Таймаут стадии llm возвращает None
+        response_text, complete = await engine.pipeline.run('llm', generate_response_stream, text, config, engine.session, on_sentence, history, request_class) or (None, False)
+    finally:
+        # Предложения, переданные до завершения генерации, уже в очереди раньше маркера конца
+        closed = True
+        voices.put_nowait(None)
+    ok = await sender
+    return response_text, sent_ids, ok, complete
+
+def extract_message(update: dict, bot: 'TelegramBot') -> Optional[dict]:
+    """Возвращает сообщение из обновления, если его нужно обрабатывать (иначе None)"""
+    # Дешёвые проверки без логирования: лишние обновления только считаются в метриках
+    message = update.get('message')
+    if not message:
+        METRICS.inc('updates_skipped_type')
+        return None
+    
+    if not bot.config.for_chat(message.get('chat', {}).get('id', '')):
+        METRICS.inc('updates_skipped_chat')
+        return None
+    
+    update_id = update.get('update_id')
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔍 Обновление #{update_id} для @{bot.username} из чата {message['chat']['id']}", file=sys.stderr)
+    # Помечаем бота и update_id для журнала обновлений
+    message['_bot_id'] = bot.bot_id
+    message['_update_id'] = update_id
+    return message
+
+async def process_updates(engine: 'BotEngine', bot: 'TelegramBot') -> bool:
+    """Получает обновления бота от Telegram (getUpdates) и ставит сообщения в очередь обработки.
+    Возвращает False при ошибке (для backoff перед следующим опросом)"""
+    config = bot.config
+    url = f"https://api.telegram.org/bot{bot.token}/getUpdates"
+    update_manager = bot.update_manager
+    
+    try:
+        params = {
+            'offset': update_manager.last_update_id + 1,
+            'timeout': 30,
+            'limit': config.updates_limit,
+            'allowed_updates': engine.allowed_updates
+        }
+        response = await run_blocking(engine.session.get, url, params=params, timeout=35, executor=engine.poll_executor)
         response.raise_for_status()
         result = response.json()
         
         if not result.get('ok'):
             error_desc = result.get('description', 'Неизвестная ошибка')
             print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Telegram API ошибка: {error_desc}", file=sys.stderr)
-            return
+            return False
         
         updates = result.get('result', [])
+        messages = [m for m in (extract_message(update, bot) for update in updates) if m]
         if updates:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📬 Получено обновлений: {len(updates)}", file=sys.stderr)
+            METRICS.inc('updates_received', len(updates))
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📬 Получено обновлений: {len(updates)}, для обработки: {len(messages)}", file=sys.stderr)
         
-        for update in updates:
-            update_id = update.get('update_id')
-            message = update.get('message')
-            
-            if not message:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏭️ Обновление #{update_id} без сообщения (пропускаю)", file=sys.stderr)
-                update_manager.update(update_id)
-                continue
-            
-            msg_chat_id = str(message.get('chat', {}).get('id', ''))
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔍 Обновление #{update_id}: chat_id={msg_chat_id}, ожидаемый={config.chat_id}", file=sys.stderr)
-            if msg_chat_id != str(config.chat_id):
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏭️ Неправильный chat_id (пропускаю)", file=sys.stderr)
-                update_manager.update(update_id)
-                continue
-            
-            update_manager.update(update_id)
-            
-            # Проверяем голосовое сообщение
-            voice = message.get('voice')
-            audio = message.get('audio')
-            text = message.get('text', '') or message.get('caption', '')
-            
-            # Если есть голосовое сообщение, транскрибируем его СНАЧАЛА
-            if voice or audio:
-                file_id = voice.get('file_id') if voice else audio.get('file_id')
-                if file_id:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎤 Получено голосовое сообщение, начинаю транскрипцию...", file=sys.stderr)
-                    
-                    # Скачиваем файл
-                    voice_file = download_voice_file(config.bot_token, file_id, session)
-                    if not voice_file:
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Не удалось скачать голосовое сообщение", file=sys.stderr)
-                        continue
-                    
-                    # Транскрибируем голосовое сообщение (пробуем разные сервисы)
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎙️ Начинаю транскрипцию голосового сообщения...", file=sys.stderr)
-                    transcribed_text = transcribe_voice(voice_file, config, session)
-                    
-                    # Удаляем временный файл
-                    try:
-                        os.remove(voice_file)
-                    except:
-                        pass
-                    
-                    if transcribed_text:
-                        text = transcribed_text
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Транскрибировано: {text[:100]}...", file=sys.stderr)
-                        # Обновляем сообщение с транскрибированным текстом для проверки should_respond
-                        message['text'] = transcribed_text
-                        # Помечаем, что это было голосовое сообщение (для should_respond)
-                        message['_was_voice'] = True
-                        # Удаляем voice/audio из сообщения, чтобы should_respond проверял только текст
-                        if 'voice' in message:
-                            del message['voice']
-                        if 'audio' in message:
-                            del message['audio']
-                    else:
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Не удалось транскрибировать голосовое сообщение", file=sys.stderr)
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}]    Попробуйте отправить текстовое сообщение", file=sys.stderr)
-                        continue
-            
-            if text:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] 📥 Новое сообщение в чате: {text[:100]}...", file=sys.stderr)
-            
-            # Проверяем, нужно ли отвечать (после транскрипции, если было голосовое)
-            if not should_respond(message, bot_username):
-                if text:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏭️ Пропускаю (не подходит под условия ответа)", file=sys.stderr)
-                continue
-            
-            if not text:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Сообщение без текста - пропускаю", file=sys.stderr)
-                continue
-            
-            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] ✅ БОТ БУДЕТ ОТВЕЧАТЬ на сообщение: {text[:50]}...", file=sys.stderr)
-            
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🤖 Генерирую ответ через AI...", file=sys.stderr)
-            response_text = generate_response(text, config, session)
-            
-            if not response_text:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ AI не смог сгенерировать ответ", file=sys.stderr)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}]    Возможные причины: превышен лимит запросов, ошибка API, или модель не ответила", file=sys.stderr)
-                time.sleep(5)
-                continue
-            
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Ответ сгенерирован: {response_text[:50]}...", file=sys.stderr)
-            
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎤 Создаю голосовое сообщение...", file=sys.stderr)
-            audio_file = generate_audio(response_text)
-            if not audio_file:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Не удалось создать аудио", file=sys.stderr)
-                continue
-            
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📤 Отправляю голосовое сообщение...", file=sys.stderr)
-            if send_voice_message(config.bot_token, config.chat_id, audio_file, session):
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Голосовое сообщение успешно отправлено!", file=sys.stderr)
-            else:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка при отправке голосового сообщения", file=sys.stderr)
-            
-            time.sleep(1)
+        # Сначала фиксируем пачку в журнале, потом одним шагом сдвигаем offset:
+        # если процесс упадёт во время обработки, сообщения останутся в журнале
+        if messages:
+            messages = await run_blocking(engine.ledger.record_batch, messages)
+        if updates:
+            update_manager.update(max(update.get('update_id', 0) for update in updates))
+        else:
+            update_manager.maybe_checkpoint()
+        
+        for message in messages:
+            await engine.submit(message)
         
     except requests.exceptions.Timeout:
         pass
     except Exception as e:
         print(f"Ошибка при обработке обновлений: {e}", file=sys.stderr)
+        return False
+    return True
+
+def chat_key(message: dict, by_thread: bool = False) -> Tuple[str, str, Optional[int]]:
+    """Ключ упорядочивания: бот, чат и (опционально) топик форума.
+    Цепочки reply веткой не считаются: reply_to_message указывает только на предыдущее
+    сообщение, и сообщения одной цепочки получили бы разные ключи"""
+    bot_id = message.get('_bot_id', '')
+    chat_id = str(message.get('chat', {}).get('id', ''))
+    if not by_thread or not message.get('is_topic_message'):
+        return bot_id, chat_id, None
+    return bot_id, chat_id, message.get('message_thread_id')
+
+class ChatScheduler:
+    """Пул воркеров с очередью на каждый ключ (чат/ветку):
+    сообщения одного ключа обрабатываются строго по порядку, разные ключи - параллельно.
+    Ключи обслуживаются по кругу, поэтому активный чат не блокирует остальные."""
+    def __init__(self, handler, workers: int, queue_size: int, on_drop: Optional[Callable[[object], None]] = None):
+        self.handler = handler
+        self.on_drop = on_drop
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queues: Dict[Tuple[str, str, Optional[int]], deque] = {}
+        self.ready: Optional[asyncio.Queue] = None
+        self.busy = 0
+        self.dropped = 0
+        self.tasks: List[asyncio.Task] = []
+    
+    def start(self):
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.workers)]
+    
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+    
+    def pending(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+    
+    def submit(self, key: Tuple[str, str, Optional[int]], item):
+        """Ставит элемент в очередь ключа; при переполнении отбрасывает самый старый"""
+        queue = self.queues.get(key)
+        if queue is None:
+            # Ключ не обрабатывается и не ждёт воркера - ставим его в очередь готовых
+            queue = self.queues[key] = deque()
+            self.ready.put_nowait(key)
+        if len(queue) >= self.queue_size:
+            dropped = queue.popleft()
+            self.dropped += 1
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Очередь чата {key[1]} переполнена, отбрасываю самое старое сообщение", file=sys.stderr)
+            if self.on_drop:
+                self.on_drop(dropped)
+        queue.append(item)
+    
+    async def worker(self):
+        while True:
+            key = await self.ready.get()
+            queue = self.queues[key]
+            item = queue.popleft()
+            self.busy += 1
+            try:
+                await self.handler(item)
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Ошибка при обработке сообщения: {e}", file=sys.stderr)
+            finally:
+                self.busy -= 1
+                if queue:
+                    # В конец очереди готовых: остальные ключи не голодают
+                    self.ready.put_nowait(key)
+                else:
+                    del self.queues[key]
+
+def merge_burst(messages: List[dict]) -> dict:
+    """Склеивает серию сообщений в одно: текст через перевод строки, метаданные от последнего"""
+    merged = dict(messages[-1])
+    merged['text'] = '\n'.join(m.get('text', '') or m.get('caption', '') for m in messages)
+    merged.pop('caption', None)
+    if not merged.get('reply_to_message'):
+        # Если хоть одно сообщение серии было reply (например, на бота), сохраняем это
+        reply = next((m['reply_to_message'] for m in messages if m.get('reply_to_message')), None)
+        if reply:
+            merged['reply_to_message'] = reply
+    merged['_burst_update_ids'] = [m.get('_update_id') for m in messages]
+    return merged
+
+class BurstCoalescer:
+    """Debounce серий сообщений: текстовые сообщения одного пользователя в одном чате (для одного бота),
+    пришедшие с интервалом меньше window секунд, склеиваются в одно (один запрос к AI и один ответ).
+    Серия отправляется дальше после паузы window, по достижении max_messages или через max_wait."""
+    def __init__(self, emit, window: float, max_wait: float, max_messages: int):
+        self.emit = emit
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self.bursts: Dict[Tuple[str, str, str], dict] = {}
+    
+    @staticmethod
+    def key(message: dict) -> Tuple[str, str, str]:
+        return message.get('_bot_id', ''), str(message.get('chat', {}).get('id', '')), str(message.get('from', {}).get('id', ''))
+    
+    def add(self, message: dict):
+        key = self.key(message)
+        if self.window <= 0 or message.get('voice') or message.get('audio'):
+            # Голосовые склеить до транскрипции нельзя: отправляем накопленное и само сообщение
+            self.flush(key)
+            self.emit(message)
+            return
+        
+        burst = self.bursts.get(key)
+        if burst is None:
+            burst = self.bursts[key] = {'messages': [], 'started': time.monotonic(), 'timer': None}
+        else:
+            burst['timer'].cancel()
+        burst['messages'].append(message)
+        
+        if len(burst['messages']) >= self.max_messages or time.monotonic() - burst['started'] >= self.max_wait:
+            self.flush(key)
+        else:
+            burst['timer'] = asyncio.get_running_loop().call_later(self.window, self.flush, key)
+    
+    def flush(self, key: Tuple[str, str, str]):
+        burst = self.bursts.pop(key, None)
+        if not burst:
+            return
+        if burst['timer']:
+            burst['timer'].cancel()
+        messages = burst['messages']
+        if len(messages) == 1:
+            self.emit(messages[0])
+            return
+        METRICS.inc('coalesced_messages', len(messages) - 1)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🧩 Склеиваю {len(messages)} сообщений подряд в один запрос", file=sys.stderr)
+        self.emit(merge_burst(messages))
+
+class TelegramBot:
+    """Один бот (токен) внутри процесса: его настройки и чаты, username, offset и путь webhook"""
+    def __init__(self, config: BotConfig, username: Optional[str], primary: bool = True):
+        self.config = config
+        self.token = config.bot_token
+        self.bot_id = config.bot_token.split(':', 1)[0]
+        self.username = username
+        # Основной бот сохраняет прежние имена файла offset и путь webhook,
+        # дополнительные получают свои (по id бота из токена)
+        self.update_manager = UpdateManager(
+            file_path=LAST_UPDATE_ID_FILE if primary else f"last_update_id_{self.bot_id}.txt",
+            checkpoint_every=config.offset_checkpoint_every,
+            checkpoint_interval=config.offset_checkpoint_interval
+        )
+        suffix = '' if primary else f"/{self.bot_id}"
+        self.webhook_path = config.webhook_path.rstrip('/') + suffix if suffix else config.webhook_path
+        self.webhook_url = (config.webhook_url or '').rstrip('/') + suffix if suffix else config.webhook_url
+
+class BotEngine:
+    """Асинхронный движок: получает обновления всех ботов процесса и обрабатывает их конкурентно
+    (max_concurrency воркеров, порядок внутри чата/ветки сохраняется). Боты делят одну HTTP-сессию,
+    конвейер стадий, журнал обновлений и кэши транскрипций/синтеза"""
+    def __init__(self, config: BotConfig, bots: List[TelegramBot], session: requests.Session):
+        self.config = config
+        self.bots: Dict[str, TelegramBot] = {bot.bot_id: bot for bot in bots}
+        self.primary_bot_id = bots[0].bot_id
+        self.session = session
+        self.scheduler = ChatScheduler(self._handle, config.max_concurrency, config.chat_queue_size, self._dropped)
+        self.ledger = UpdateLedger(config.ledger_file, self.primary_bot_id)
+        self.pipeline = Pipeline(config.pipeline_stages)
+        # Long polling держит поток до 35 секунд: у него свой пул, чтобы не занимать потоки стадий
+        self.poll_executor = ThreadPoolExecutor(max_workers=len(self.bots), thread_name_prefix='telegram-poll')
+        self.llm_backoff = Backoff(base=1.0, cap=30.0)
+        # Общие кэши: транскрипция по file_unique_id, синтез по (голос, текст)
+        self.asr_cache = LRUCache(256)
+        self.tts_cache = LRUCache(64)
+        # Одинаковые запросы, которые выполняются прямо сейчас, не дублируются
+        self.asr_flight = SingleFlight('asr')
+        self.llm_flight = SingleFlight('llm')
+        self.tts_flight = SingleFlight('tts')
+        self.memory = ConversationMemory(config.memory_max_turns)
+        self.response_cache = ResponseCache(config.response_cache_size, config.response_cache_ttl, config.response_cache_file)
+        # getUpdates принимает allowed_updates как JSON-массив
+        self.allowed_updates = json.dumps(HANDLED_UPDATE_TYPES)
+        self.coalescer = BurstCoalescer(self.dispatch, config.coalesce_window, config.coalesce_max_wait, config.coalesce_max_messages)
+    
+    async def submit(self, message: dict):
+        """Принимает сообщение (с возможной склейкой серии) и ставит его в очередь чата/ветки"""
+        self.coalescer.add(message)
+    
+    def dispatch(self, message: dict):
+        self.scheduler.submit(chat_key(message, self.config.order_by_thread), message)
+    
+    async def mark(self, message: dict, state: str):
+        """Отмечает в журнале состояние сообщения (или всех сообщений склеенной серии)"""
+        for update_id in message.get('_burst_update_ids') or [message.get('_update_id')]:
+            await run_blocking(self.ledger.mark, message.get('_bot_id', ''), update_id, state)
+    
+    def _dropped(self, message: dict):
+        """Сообщение вытеснено из переполненной очереди чата: отвечать на него уже не будем"""
+        asyncio.ensure_future(self.mark(message, 'failed'))
+    
+    async def _handle(self, message: dict):
+        await self.mark(message, 'processing')
+        try:
+            handled = await handle_message(message, self)
+        except Exception:
+            await self.mark(message, 'retry')
+            raise
+        await self.mark(message, 'done' if handled else 'retry')
+    
+    async def handle_webhook_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Принимает POST от Telegram: по пути находит бота, проверяет его секрет,
+        сразу отвечает 200 и ставит обновление в очередь"""
+        message = None
+        status = '400 Bad Request'
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            
+            length = int(headers.get('content-length', 0))
+            secret = headers.get('x-telegram-bot-api-secret-token', '')
+            path = path.split('?', 1)[0]
+            bot = next((b for b in self.bots.values() if b.webhook_path == path), None)
+            if method != 'POST' or not bot:
+                status = '404 Not Found'
+            elif not hmac.compare_digest(secret, bot.config.webhook_secret):
+                status = '403 Forbidden'
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Webhook: неверный секретный токен", file=sys.stderr)
+            elif length > WEBHOOK_MAX_BODY:
+                status = '413 Payload Too Large'
+            else:
+                body = await asyncio.wait_for(reader.readexactly(length), timeout=10)
+                message = extract_message(json.loads(body.decode('utf-8')), bot)
+                # Подтверждаем доставку только после записи в журнал
+                if message and not await run_blocking(self.ledger.record_batch, [message]):
+                    message = None  # повторная доставка уже записанного обновления
+                status = '200 OK'
+        except Exception as e:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Webhook: некорректный запрос: {e}", file=sys.stderr)
+        
+        # Отвечаем до обработки, чтобы Telegram не ждал и не повторял доставку
+        try:
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode('latin-1'))
+            await writer.drain()
+            writer.close()
+        except Exception:
+            pass
+        
+        if message:
+            await self.submit(message)
+    
+    def reload_config(self):
+        """Перечитывает telegram_config.json (сигнал SIGHUP): настройки ботов и чатов,
+        промпты и шаблоны провайдеров. Параметры движка (конкурентность, стадии, режим)
+        применяются только после перезапуска. Секрет webhook остаётся прежним: Telegram
+        знает только тот, с которым webhook был зарегистрирован"""
+        config = get_config()
+        if not config:
+            return
+        reloaded = 0
+        for bot_config in config.all_bots():
+            bot = self.bots.get(bot_config.bot_token.split(':', 1)[0])
+            if bot:
+                bot_config.webhook_secret = bot.config.webhook_secret
+                bot.config = bot_config
+                reloaded += 1
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 Конфигурация перечитана, ботов обновлено: {reloaded}", file=sys.stderr)
+    
+    async def log_status(self):
+        """Периодический статус: загрузка воркеров и метрики"""
+        # Сбой статуса не должен останавливать движок (цикл статуса - это основной цикл run_*)
+        try:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏳ Бот работает, ожидаю сообщения... (в обработке: {self.scheduler.busy}, в очереди: {self.scheduler.pending()})", file=sys.stderr)
+            if isinstance(self.session, HttpClient):
+                self.session.update_metrics()
+            summary = METRICS.summary()
+            if summary:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 📊 {summary}", file=sys.stderr)
+            breakers = BREAKERS.summary()
+            if breakers:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔴 Разомкнутые цепи: {breakers}", file=sys.stderr)
+            slo = self.class_slo_summary()
+            if slo:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏱️ Время ответа AI (p95 / SLO): {slo}", file=sys.stderr)
+            routing = ROUTER.summary()
+            if routing:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🧭 Провайдеры: {routing}", file=sys.stderr)
+                # Запись с fsync - в пуле потоков, чтобы медленный диск не задерживал цикл событий
+                await run_blocking(ROUTER.save, self.config.router_state_file)
+            await run_blocking(self.response_cache.save)
+        except Exception as e:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Ошибка при выводе статуса: {e}", file=sys.stderr)
+    
+    async def retry_pending(self):
+        """Повторяет обработку сообщений, ответ на которые не удалось отправить,
+        не дожидаясь перезапуска процесса"""
+        try:
+            retries = [m for m in await run_blocking(self.ledger.due_retries) if m.setdefault('_bot_id', self.primary_bot_id) in self.bots]
+        except sqlite3.Error as e:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️ Ошибка журнала при повторе ответов: {e}", file=sys.stderr)
+            return
+        if retries:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ♻️ Повторяю неотправленные ответы: {len(retries)}", file=sys.stderr)
+        for message in retries:
+            await self.submit(message)
+    
+    def class_slo_summary(self) -> str:
+        parts = []
+        for name, settings in self.config.request_classes.items():
+            p95 = METRICS.percentile(f"llm.class.{name}", 95)
+            if p95 is not None:
+                parts.append(f"{name} {p95:.1f}/{settings.get('slo', 0):g} сек")
+        return ', '.join(parts)
+    
+    async def poll_bot(self, bot: TelegramBot):
+        """Long polling (getUpdates) одного бота"""
+        # Long polling сам ждёт новых сообщений на стороне Telegram, поэтому
+        # следующий опрос идёт сразу; пауза (backoff с jitter) только после ошибок
+        backoff = Backoff(base=1.0, cap=60.0)
+        while True:
+            if await process_updates(self, bot):
+                backoff.success()
+            else:
+                delay = backoff.failure()
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏳ Повторный опрос @{bot.username} через {delay:.1f} сек", file=sys.stderr)
+                await asyncio.sleep(delay)
+    
+    async def run_polling(self):
+        """Получение обновлений через long polling: отдельный цикл опроса на каждого бота"""
+        polls = [asyncio.ensure_future(self.poll_bot(bot)) for bot in self.bots.values()]
+        try:
+            # Каждые 60 секунд выводим статус и очищаем временные файлы
+            while True:
+                cleanup_temp_voice_files()
+                await asyncio.sleep(60)
+                await self.log_status()
+                await self.retry_pending()
+        finally:
+            for task in polls:
+                task.cancel()
+    
+    async def run_webhook(self):
+        """Получение обновлений через webhook: один локальный HTTP сервер на всех ботов + регистрация в Telegram"""
+        server = await asyncio.start_server(self.handle_webhook_request, self.config.webhook_host, self.config.webhook_port)
+        registered = []
+        try:
+            for bot in self.bots.values():
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🌐 Webhook сервер слушает {self.config.webhook_host}:{self.config.webhook_port}{bot.webhook_path} (@{bot.username})", file=sys.stderr)
+                if not await run_blocking(set_webhook, bot, self.session):
+                    return
+                registered.append(bot)
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Webhook зарегистрирован: {bot.webhook_url}", file=sys.stderr)
+            while True:
+                cleanup_temp_voice_files()
+                await asyncio.sleep(60)
+                await self.log_status()
+                await self.retry_pending()
+        finally:
+            server.close()
+            for bot in registered if self.config.webhook_delete_on_exit else []:
+                if await run_blocking(delete_webhook, bot.token, self.session):
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Webhook @{bot.username} удален", file=sys.stderr)
+    
+    async def run(self):
+        """Основной цикл: получение обновлений (polling или webhook) + параллельная обработка"""
+        # Стадии и long polling работают в своих пулах потоков, общий пул цикла событий
+        # остаётся для коротких вызовов (журнал, регистрация webhook)
+        loop = asyncio.get_running_loop()
+        self.pipeline.start()
+        self.scheduler.start()
+        if hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, self.reload_config)
+        ROUTER.explore_ratio = self.config.router_explore_ratio
+        ROUTER.load(self.config.router_state_file)
+        self.response_cache.load()
+        BREAKERS.failure_threshold = self.config.breaker_failure_threshold
+        BREAKERS.reset_timeout = self.config.breaker_reset_timeout
+        RATE_LIMITER.configure(self.config.rate_limits, self.config.rate_limit_max_wait)
+        hedge_parallel = max(chat.hedge_max_parallel for bot in self.bots.values() for chat in [bot.config, *bot.config.chats.values()])
+        configure_hedging(int(self.config.pipeline_stages['llm']['workers']) * hedge_parallel)
+        
+        # Досылаем сообщения, обработка которых прервалась при прошлом запуске
+        # (записи старого формата без бота относятся к основному боту)
+        self.ledger.prune()
+        unfinished = [m for m in self.ledger.unfinished() if m.setdefault('_bot_id', self.primary_bot_id) in self.bots]
+        if unfinished:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ♻️ Возобновляю обработку незавершённых сообщений: {len(unfinished)}", file=sys.stderr)
+        for message in unfinished:
+            await self.submit(message)
+        
+        try:
+            if self.config.use_webhook():
+                await self.run_webhook()
+            else:
+                await self.run_polling()
+        finally:
+            self.scheduler.stop()
+            self.pipeline.stop()
+            self.poll_executor.shutdown(wait=False)
+            for bot in self.bots.values():
+                bot.update_manager.checkpoint()
+            ROUTER.save(self.config.router_state_file)
+            self.response_cache.save()
+            self.ledger.close()
 
 def get_config() -> Optional[BotConfig]:
     """Получает конфигурацию из файла telegram_config.json"""
@@ -1043,16 +3315,35 @@ def main():
     if not config:
         sys.exit(1)
     
-    if not config.bot_token or config.bot_token == "YOUR_BOT_TOKEN_HERE":
+    bot_configs = config.all_bots()
+    # Заглушки из telegram_config.json.example начинаются с YOUR_
+    if not bot_configs or any(is_placeholder(b.bot_token) for b in bot_configs):
         print("Ошибка: bot_token не настроен", file=sys.stderr)
         sys.exit(1)
     
-    if not config.chat_id or config.chat_id == "YOUR_CHAT_ID_HERE":
-        print("Ошибка: chat_id не настроен", file=sys.stderr)
+    for bot_config in bot_configs:
+        if not bot_config.chats or any(is_placeholder(chat_id) for chat_id in bot_config.chats):
+            print("Ошибка: chat_id не настроен", file=sys.stderr)
+            sys.exit(1)
+    
+    if config.use_webhook() and not config.webhook_url:
+        print("Ошибка: для mode=webhook нужен webhook_url", file=sys.stderr)
         sys.exit(1)
     
-    # Создаем сессию для переиспользования соединений
-    session = requests.Session()
+    if config.use_webhook() and any(not b.webhook_secret for b in bot_configs):
+        print("Ошибка: для mode=webhook нужен webhook_secret (одинаковый у всех экземпляров бота)", file=sys.stderr)
+        sys.exit(1)
+    
+    # Общий HTTP клиент для переиспользования соединений
+    # (пул на каждый хост под конкурентную обработку)
+    session = HttpClient(
+        pool_size=int(config.http_pool_size or sum(int(stage['workers']) for stage in config.pipeline_stages.values()) + len(bot_configs) + 1),
+        host_pools=config.http_pools,
+        connect_timeout=config.http_connect_timeout,
+        total_timeout=config.http_total_timeout,
+        keepalive=config.http_keepalive,
+        http2=config.http2
+    )
     
     # Выводим красивый заголовок
     print("\n" + "=" * 60, file=sys.stderr)
@@ -1060,6 +3351,12 @@ def main():
     print("=" * 60, file=sys.stderr)
     
     print("\n📡 Статус подключений:", file=sys.stderr)
+    for endpoint in config.provider_registry:
+        if has_credentials(endpoint):
+            print(f"   ✅ {endpoint.get('name', 'API')}: {endpoint.get('base_url') or endpoint.get('url')}", file=sys.stderr)
+            print(f"      Модели: {', '.join(endpoint.get('models') or [endpoint.get('model', '')])}", file=sys.stderr)
+        else:
+            print(f"   ⚠️ {endpoint.get('name', 'API')}: API ключ не настроен", file=sys.stderr)
     if config.has_zenmux():
         print(f"   ✅ ZenMux.ai: подключен (основной)", file=sys.stderr)
         print(f"      Основная модель: {config.zenmux_model}", file=sys.stderr)
@@ -1090,6 +3387,9 @@ def main():
         print("\n   ❌ Нет ни одного API ключа - бот не будет отвечать", file=sys.stderr)
         print("      Добавьте хотя бы один API ключ в telegram_config.json", file=sys.stderr)
     
+    http_mode = "HTTP/2 (httpx)" if session.http2 else "HTTP/1.1 keep-alive"
+    print(f"   🌐 HTTP: {http_mode}, пул {session.pool_size} соединений на хост", file=sys.stderr)
+    
     personality_names = {
         "putin": "Владимир Путин",
         "default": "Обычный бот",
@@ -1097,55 +3397,68 @@ def main():
         "professional": "Профессиональный",
         "funny": "Веселый"
     }
-    personality_display = personality_names.get(config.personality, f"Кастомная: {config.personality[:30]}")
-    print(f"\n🎭 Личность бота: {personality_display}", file=sys.stderr)
-    
-    print("\n🔍 Проверка бота...", file=sys.stderr)
-    bot_info = get_bot_info(config.bot_token, session)
-    if bot_info:
-        bot_username = bot_info.get('username')
-        bot_name = bot_info.get('first_name', '')
-        print(f"   ✅ Бот найден: @{bot_username} ({bot_name})", file=sys.stderr)
-    else:
-        bot_username = None
-        print("   ❌ Не удалось получить информацию о боте", file=sys.stderr)
-        print("      Проверьте правильность bot_token", file=sys.stderr)
     
-    print(f"\n💬 Чат ID: {config.chat_id}", file=sys.stderr)
-    
-    # Проверяем last_update_id
-    try:
-        if os.path.exists(LAST_UPDATE_ID_FILE):
-            with open(LAST_UPDATE_ID_FILE, 'r') as f:
-                last_id = f.read().strip()
-                if last_id:
-                    print(f"📋 Последний обработанный update_id: {last_id}", file=sys.stderr)
-                else:
-                    print(f"📋 Файл {LAST_UPDATE_ID_FILE} пуст, начну с начала", file=sys.stderr)
+    bots = []
+    for index, bot_config in enumerate(bot_configs):
+        print("\n🔍 Проверка бота...", file=sys.stderr)
+        bot_info = get_bot_info(bot_config.bot_token, session)
+        if bot_info:
+            bot_username = bot_info.get('username')
+            bot_name = bot_info.get('first_name', '')
+            print(f"   ✅ Бот найден: @{bot_username} ({bot_name})", file=sys.stderr)
         else:
-            print(f"📋 Файл {LAST_UPDATE_ID_FILE} не найден, начну с начала", file=sys.stderr)
-    except Exception as e:
-        print(f"⚠️ Не удалось прочитать {LAST_UPDATE_ID_FILE}: {e}", file=sys.stderr)
-    
-    # Удаляем webhook, если он установлен (для работы в режиме long polling)
-    print("\n🔄 Проверяю режим работы бота...", file=sys.stderr)
-    try:
-        webhook_url = f"https://api.telegram.org/bot{config.bot_token}/getWebhookInfo"
-        webhook_response = session.get(webhook_url, timeout=10)
-        if webhook_response.status_code == 200:
-            webhook_info = webhook_response.json()
-            if webhook_info.get('ok') and webhook_info.get('result', {}).get('url'):
-                print("   ⚠️ Обнаружен установленный webhook, удаляю...", file=sys.stderr)
-                delete_url = f"https://api.telegram.org/bot{config.bot_token}/deleteWebhook"
-                delete_response = session.post(delete_url, timeout=10)
-                if delete_response.status_code == 200:
-                    print("   ✅ Webhook удален, бот переключен на режим long polling", file=sys.stderr)
-                else:
-                    print("   ⚠️ Не удалось удалить webhook автоматически", file=sys.stderr)
+            bot_username = None
+            print("   ❌ Не удалось получить информацию о боте", file=sys.stderr)
+            print("      Проверьте правильность bot_token", file=sys.stderr)
+        bot = TelegramBot(bot_config, bot_username, primary=(index == 0))
+        bots.append(bot)
+        
+        for chat_id, chat_config in bot_config.chats.items():
+            personality_display = personality_names.get(chat_config.personality, f"Кастомная: {chat_config.personality[:30]}")
+            voice_display = f", голос: {chat_config.voice_id}" if chat_config.voice_id else ""
+            print(f"   💬 Чат ID: {chat_id} - 🎭 {personality_display}{voice_display}", file=sys.stderr)
+        
+        # Проверяем last_update_id
+        offset_file = bot.update_manager.file_path
+        try:
+            if os.path.exists(offset_file):
+                with open(offset_file, 'r') as f:
+                    last_id = f.read().strip()
+                    if last_id:
+                        print(f"   📋 Последний обработанный update_id: {last_id}", file=sys.stderr)
+                    else:
+                        print(f"   📋 Файл {offset_file} пуст, начну с начала", file=sys.stderr)
             else:
-                print("   ✅ Бот работает в режиме long polling (getUpdates)", file=sys.stderr)
-    except Exception as e:
-        print(f"   ⚠️ Не удалось проверить webhook: {e}", file=sys.stderr)
+                print(f"   📋 Файл {offset_file} не найден, начну с начала", file=sys.stderr)
+        except Exception as e:
+            print(f"   ⚠️ Не удалось прочитать {offset_file}: {e}", file=sys.stderr)
+        
+        # В режиме webhook регистрация происходит при запуске движка (BotEngine.run_webhook)
+        print("   🔄 Проверяю режим работы бота...", file=sys.stderr)
+        if config.use_webhook():
+            print(f"   ✅ Режим webhook: {bot.webhook_url}", file=sys.stderr)
+            print(f"      Локальный сервер: {config.webhook_host}:{config.webhook_port}{bot.webhook_path}", file=sys.stderr)
+        else:
+            # Удаляем webhook, если он установлен (для работы в режиме long polling)
+            try:
+                webhook_url = f"https://api.telegram.org/bot{bot.token}/getWebhookInfo"
+                webhook_response = session.get(webhook_url, timeout=10)
+                if webhook_response.status_code == 200:
+                    webhook_info = webhook_response.json()
+                    if webhook_info.get('ok') and webhook_info.get('result', {}).get('url'):
+                        print("   ⚠️ Обнаружен установленный webhook, удаляю...", file=sys.stderr)
+                        delete_url = f"https://api.telegram.org/bot{bot.token}/deleteWebhook"
+                        delete_response = session.post(delete_url, timeout=10)
+                        if delete_response.status_code == 200:
+                            print("   ✅ Webhook удален, бот переключен на режим long polling", file=sys.stderr)
+                        else:
+                            print("   ⚠️ Не удалось удалить webhook автоматически", file=sys.stderr)
+                    else:
+                        print("   ✅ Бот работает в режиме long polling (getUpdates)", file=sys.stderr)
+            except Exception as e:
+                print(f"   ⚠️ Не удалось проверить webhook: {e}", file=sys.stderr)
+    
+    print(f"\n⚙️ Параллельная обработка: до {config.max_concurrency} сообщений одновременно", file=sys.stderr)
     
     print("\n" + "=" * 60, file=sys.stderr)
     print("📋 БОТ АКТИВЕН И СЛУШАЕТ СООБЩЕНИЯ", file=sys.stderr)
@@ -1166,18 +3479,7 @@ def main():
     print("\n" + "-" * 60 + "\n", file=sys.stderr)
     
     try:
-        last_status_time = time.time()
-        while True:
-            cleanup_temp_voice_files()  # Периодически очищаем временные файлы
-            process_updates(config, bot_username, session)
-            
-            # Каждые 60 секунд выводим статус (если нет активности)
-            current_time = time.time()
-            if current_time - last_status_time > 60:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⏳ Бот работает, ожидаю сообщения...", file=sys.stderr)
-                last_status_time = current_time
-            
-            time.sleep(1)
+        asyncio.run(BotEngine(config, bots, session).run())
     except KeyboardInterrupt:
         print("\n\n" + "=" * 60, file=sys.stderr)
         print("🛑 БОТ ОСТАНОВЛЕН ПОЛЬЗОВАТЕЛЕМ", file=sys.stderr)
@@ -256,7 +256,8 @@ def main():
     
     try:
         api_key = get_api_key()
-        result = text_to_speech(text, api_key)
+        # Голос конкретного чата передаётся ботом через переменную окружения
+        result = text_to_speech(text, api_key, voice_id=os.getenv('MINIMAX_VOICE_ID'))
         
         # Результат будет сохранен в функции text_to_speech
         
@@ -292,11 +293,18 @@ def main():
                 next_num = 1
             
             # Генерируем имя файла с простой нумерацией
-            audio_filename = f"{audio_dir}/{next_num}.mp3"
-            json_filename = f"{audio_dir}/{next_num}.json"
+            # (эксклюзивное создание: бот может запускать несколько синтезов одновременно)
+            while True:
+                audio_filename = f"{audio_dir}/{next_num}.mp3"
+                json_filename = f"{audio_dir}/{next_num}.json"
+                try:
+                    f = open(audio_filename, "xb")
+                    break
+                except FileExistsError:
+                    next_num += 1
             
             # Сохраняем аудио
-            with open(audio_filename, "wb") as f:
+            with f:
                 f.write(audio_data)
             print(f"Аудио файл сохранен: {audio_filename}", file=sys.stderr)
             